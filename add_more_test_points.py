@@ -4,8 +4,11 @@
 import os
 import sys
 import logging
+import re
 import sqlite3
 from datetime import datetime, timedelta
+from pathlib import Path
+from random import uniform as _uniform
 
 # Настройка логирования
 logging.basicConfig(
@@ -14,7 +17,106 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def add_location_points(user_id, session_id, segment_num, recreate=True):
+# База данных
+DATABASE_FILE = 'tracker.db'
+
+# Запрос вставки точки маршрута (один текст - один подготовленный запрос в кэше sqlite3)
+INSERT_POINT_SQL = (
+    "INSERT INTO location_history (user_id, latitude, longitude, timestamp, session_id, location_type) "
+    "VALUES (?, ?, ?, CAST(strftime('%s', ?) AS INTEGER), ?, ?)"
+)
+
+def configure_connection(conn, db_path=DATABASE_FILE):
+    """
+    Настраивает соединение с SQLite: WAL-журнал, облегченная синхронизация и mmap
+    
+    Args:
+        conn: Открытое соединение sqlite3
+        db_path (str): Путь к файлу базы данных
+    """
+    # Для базы в памяти журнал и fsync не имеют смысла
+    if db_path == ':memory:':
+        return
+    
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-20000")
+    # Чтение страниц через отображение файла в память (256 МБ);
+    # где mmap не поддерживается, SQLite просто игнорирует настройку
+    cursor.execute("PRAGMA mmap_size=268435456")
+
+# Старые варианты тултипов в fixed_map_generator.py и их замены
+_POINT_TOOLTIP = "tooltip=f\"⏱️ {time_str} | 📍[{lat:.6f}, {lon:.6f}] | 📋 {current_status}\","
+_SEGMENT_START_TOOLTIP = "tooltip=f\"🟢 НАЧАЛО сегмента {i+1} | ⏱️ {time_str} | 📍[{lat:.6f}, {lon:.6f}] | 📋 {current_status}\""
+_SEGMENT_END_TOOLTIP = "tooltip=f\"🔴 КОНЕЦ сегмента {i+1} | ⏱️ {time_str} | 📍[{lat:.6f}, {lon:.6f}] | 📋 {current_status}\""
+
+TOOLTIP_REPLACEMENTS = {
+    # Обычные точки
+    "tooltip=f\"{time_str}\",": _POINT_TOOLTIP,
+    "tooltip=f\"Время: {time_str} | Статус: {current_status}\",": _POINT_TOOLTIP,
+    # Начало сегмента
+    "tooltip=f\"НАЧАЛО сегмента {i+1}\"": _SEGMENT_START_TOOLTIP,
+    "tooltip=f\"НАЧАЛО сегмента {i+1} | Статус: {current_status}\"": _SEGMENT_START_TOOLTIP,
+    # Конец сегмента
+    "tooltip=f\"КОНЕЦ сегмента {i+1}\"": _SEGMENT_END_TOOLTIP,
+    "tooltip=f\"КОНЕЦ сегмента {i+1} | Статус: {current_status}\"": _SEGMENT_END_TOOLTIP,
+    # Начало и конец всего маршрута
+    "tooltip=\"Начало маршрута\",": "tooltip=f\"🟢 Начало маршрута | ⏱️ {first_event[3]} | 📍[{lat:.6f}, {lon:.6f}]\",",
+    "tooltip=\"Конец маршрута\",": "tooltip=f\"🔴 Конец маршрута | ⏱️ {last_event[3]} | 📍[{lat:.6f}, {lon:.6f}]\",",
+}
+
+# Длинные варианты идут первыми, чтобы альтернатива не срабатывала на префиксе
+TOOLTIP_PATTERN = re.compile("|".join(
+    re.escape(old) for old in sorted(TOOLTIP_REPLACEMENTS, key=len, reverse=True)
+))
+
+# Индексы под выборки и удаления по диапазону времени для пользователя
+HISTORY_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS ix_loc_user_ts ON location_history(user_id, timestamp)",
+    "CREATE INDEX IF NOT EXISTS ix_status_user_ts ON status_history(user_id, timestamp)",
+)
+
+_indexes_ensured = False
+
+def ensure_history_indexes(conn):
+    """
+    Создает составные индексы (user_id, timestamp) и обновляет статистику планировщика.
+    Выполняется один раз за процесс, повторные вызовы ничего не делают
+    
+    Args:
+        conn: Открытое соединение sqlite3
+    """
+    global _indexes_ensured
+    if _indexes_ensured:
+        return
+    
+    cursor = conn.cursor()
+    for statement in HISTORY_INDEXES:
+        cursor.execute(statement)
+    # Без статистики планировщик может не выбрать новые индексы
+    cursor.execute("ANALYZE")
+    _indexes_ensured = True
+
+# Метка, которую update_tooltips_for_markers дописывает после обновления файла
+TOOLTIPS_SENTINEL = "# __tooltips_patched_v1__"
+
+def open_connection():
+    """
+    Открывает соединение с базой данных с ручным управлением транзакциями
+    
+    Returns:
+        sqlite3.Connection: Настроенное соединение
+    """
+    # isolation_level=None отключает неявные BEGIN модуля sqlite3,
+    # транзакцией управляем сами
+    conn = sqlite3.connect(DATABASE_FILE, isolation_level=None)
+    configure_connection(conn)
+    ensure_history_indexes(conn)
+    return conn
+
+def add_location_points(user_id, session_id, segment_num, recreate=True, conn=None):
     """
     Добавляет точные 5 точек для сегмента маршрута, с нужными временными отметками
     
@@ -23,12 +125,20 @@ def add_location_points(user_id, session_id, segment_num, recreate=True):
         session_id (str): ID сессии
         segment_num (int): Номер сегмента (1 или 2)
         recreate (bool): Если True, удаляет существующие точки и создает новые
+        conn: Открытое соединение; если передано, транзакцией и закрытием
+            управляет вызывающий код
     """
+    own_connection = conn is None
     try:
         # Подключение к базе данных
-        conn = sqlite3.connect('tracker.db')
+        if own_connection:
+            conn = open_connection()
         cursor = conn.cursor()
         
+        # Все удаления и вставки сегмента выполняются в одной транзакции
+        if own_connection:
+            cursor.execute("BEGIN IMMEDIATE")
+        
         # Определяем временные рамки сегмента
         if segment_num == 1:
             # Первый сегмент (В офисе)
@@ -47,16 +157,11 @@ def add_location_points(user_id, session_id, segment_num, recreate=True):
         
         # Если нужно, удаляем существующие точки
         if recreate:
-            if segment_num == 1:
-                cursor.execute(
-                    "DELETE FROM location_history WHERE user_id = ? AND timestamp BETWEEN ? AND ?",
-                    (user_id, start_time_str, end_time_str)
-                )
-            else:
-                cursor.execute(
-                    "DELETE FROM location_history WHERE user_id = ? AND timestamp BETWEEN ? AND ?",
-                    (user_id, start_time_str, end_time_str)
-                )
+            cursor.execute(
+                "DELETE FROM location_history WHERE user_id = ? AND timestamp "
+                "BETWEEN CAST(strftime('%s', ?) AS INTEGER) AND CAST(strftime('%s', ?) AS INTEGER)",
+                (user_id, start_time_str, end_time_str)
+            )
             
             # Также удаляем статусы для чистоты эксперимента
             cursor.execute(
@@ -71,138 +176,122 @@ def add_location_points(user_id, session_id, segment_num, recreate=True):
             )
         
         # Конвертируем временные значения
-        start_time = datetime.strptime(start_time_str, "%Y-%m-%d %H:%M:%S")
-        end_time = datetime.strptime(end_time_str, "%Y-%m-%d %H:%M:%S")
+        # Строки уже в формате ISO 8601, fromisoformat разбирает их без шаблона
+        start_time = datetime.fromisoformat(start_time_str)
+        end_time = datetime.fromisoformat(end_time_str)
         
         # Вычисляем шаг для создания ровно 5 точек (включая начальную и конечную)
         time_step = (end_time - start_time) / 4  # 4 интервала для 5 точек
         
         # Координаты для промежуточных точек - создаем плавную линию
-        # Добавляем начальную точку
-        location_type = "start" if segment_num == 1 else "intermediate"
-        cursor.execute(
-            "INSERT INTO location_history (user_id, latitude, longitude, timestamp, session_id, location_type) VALUES (?, ?, ?, ?, ?, ?)",
-            (user_id, start_coords[0], start_coords[1], start_time_str, session_id, location_type)
-        )
+        # Начальная точка открывает маршрут только в первом сегменте
+        points = [(
+            user_id,
+            start_coords[0],
+            start_coords[1],
+            start_time_str,
+            session_id,
+            "start" if segment_num == 1 else "intermediate"
+        )]
         
-        # Создаем промежуточные точки (3 штуки)
-        points = []
-        for i in range(1, 4):
-            # Линейная интерполяция координат
-            progress = i / 4.0  # от 0.25 до 0.75
-            lat = start_coords[0] + (end_coords[0] - start_coords[0]) * progress
-            lon = start_coords[1] + (end_coords[1] - start_coords[1]) * progress
-            
-            # Добавляем небольшое случайное отклонение для реалистичности
-            import random
-            lat_jitter = random.uniform(-0.0003, 0.0003)
-            lon_jitter = random.uniform(-0.0003, 0.0003)
-            lat += lat_jitter
-            lon += lon_jitter
-            
-            # Вычисляем время для этой точки
-            point_time = start_time + time_step * i
-            point_time_str = point_time.strftime("%Y-%m-%d %H:%M:%S")
-            
-            points.append((
-                user_id, 
-                lat, 
-                lon, 
-                point_time_str, 
-                session_id, 
+        # Создаем промежуточные точки (3 штуки) одним проходом:
+        # приращения координат считаются один раз, на шаг остается
+        # только умножение на долю пути и случайное отклонение
+        start_lat, start_lon = start_coords
+        lat_delta = end_coords[0] - start_lat
+        lon_delta = end_coords[1] - start_lon
+        points.extend(
+            (
+                user_id,
+                start_lat + lat_delta * (i / 4.0) + _uniform(-0.0003, 0.0003),
+                start_lon + lon_delta * (i / 4.0) + _uniform(-0.0003, 0.0003),
+                # isoformat - один вызов без разбора строки формата strftime
+                (start_time + time_step * i).isoformat(sep=' ', timespec='seconds'),
+                session_id,
                 "intermediate"
-            ))
-        
-        # Добавляем промежуточные точки
-        cursor.executemany(
-            "INSERT INTO location_history (user_id, latitude, longitude, timestamp, session_id, location_type) VALUES (?, ?, ?, ?, ?, ?)",
-            points
+            )
+            for i in range(1, 4)  # доля пути от 0.25 до 0.75
         )
         
-        # Добавляем конечную точку
-        location_type = "end" if segment_num == 2 else "intermediate"
-        cursor.execute(
-            "INSERT INTO location_history (user_id, latitude, longitude, timestamp, session_id, location_type) VALUES (?, ?, ?, ?, ?, ?)",
-            (user_id, end_coords[0], end_coords[1], end_time_str, session_id, location_type)
-        )
+        # Конечная точка закрывает маршрут только во втором сегменте
+        points.append((
+            user_id,
+            end_coords[0],
+            end_coords[1],
+            end_time_str,
+            session_id,
+            "end" if segment_num == 2 else "intermediate"
+        ))
         
-        conn.commit()
+        # Добавляем все 5 точек одним запросом
+        cursor.executemany(INSERT_POINT_SQL, points)
+        
+        if own_connection:
+            cursor.execute("COMMIT")
         logger.info(f"Создано 5 точек для сегмента {segment_num} со статусом '{status}'")
         return True
         
     except Exception as e:
         logger.error(f"Ошибка добавления точек: {e}")
+        if own_connection and conn and conn.in_transaction:
+            conn.execute("ROLLBACK")
         return False
     finally:
-        if 'conn' in locals() and conn:
+        if own_connection and conn:
             conn.close()
 
+def tooltips_already_patched(file_path):
+    """
+    Проверяет, стоит ли в конце файла метка уже выполненного обновления тултипов
+    
+    Args:
+        file_path (Path): Путь к fixed_map_generator.py
+        
+    Returns:
+        bool: True, если файл уже обновлялся
+    """
+    sentinel = TOOLTIPS_SENTINEL.encode('utf-8')
+    with open(file_path, 'rb') as f:
+        # Метка дописывается в конец, поэтому достаточно прочитать хвост файла
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - 4096))
+        return sentinel in f.read()
+
 def update_tooltips_for_markers():
     """
     Обновляет отображение времени и координат для всех точек, чтобы они всегда были видны в тултипах
     """
     try:
+        file_path = Path('fixed_map_generator.py')
+        
+        # Файл уже обновлялся ранее - не сканируем его повторно
+        if tooltips_already_patched(file_path):
+            logger.info("Тултипы уже обновлены ранее, пропускаем проверку")
+            return True
+        
         # Проверяем, есть ли изменения в fixed_map_generator.py, которые нужно внести
         import fixed_map_generator
-        file_path = 'fixed_map_generator.py'
-        with open(file_path, 'r') as f:
-            content = f.read()
+        content = file_path.read_text(encoding='utf-8')
         
         # Проверяем, содержит ли файл маркер для обычных точек
         if "tooltip=f\"" in content:
             logger.info("Обновляем отображение в тултипах для всех типов точек")
-            updated_content = content
             
-            # Обновляем тултипы для обычных точек
-            if "tooltip=f\"{time_str}\"," in content:
-                updated_content = updated_content.replace(
-                    "tooltip=f\"{time_str}\",", 
-                    "tooltip=f\"⏱️ {time_str} | 📍[{lat:.6f}, {lon:.6f}] | 📋 {current_status}\","
-                )
-            elif "tooltip=f\"Время: {time_str}" in content:
-                updated_content = updated_content.replace(
-                    "tooltip=f\"Время: {time_str} | Статус: {current_status}\",", 
-                    "tooltip=f\"⏱️ {time_str} | 📍[{lat:.6f}, {lon:.6f}] | 📋 {current_status}\","
-                )
-            
-            # Обновляем тултипы для начала сегмента
-            if "tooltip=f\"НАЧАЛО сегмента {i+1}\"" in content:
-                updated_content = updated_content.replace(
-                    "tooltip=f\"НАЧАЛО сегмента {i+1}\"", 
-                    "tooltip=f\"🟢 НАЧАЛО сегмента {i+1} | ⏱️ {time_str} | 📍[{lat:.6f}, {lon:.6f}] | 📋 {current_status}\""
-                )
-            elif "tooltip=f\"НАЧАЛО сегмента {i+1} | Статус:" in content:
-                updated_content = updated_content.replace(
-                    "tooltip=f\"НАЧАЛО сегмента {i+1} | Статус: {current_status}\"", 
-                    "tooltip=f\"🟢 НАЧАЛО сегмента {i+1} | ⏱️ {time_str} | 📍[{lat:.6f}, {lon:.6f}] | 📋 {current_status}\""
-                )
+            # Все замены выполняются за один проход по файлу
+            updated_content = TOOLTIP_PATTERN.sub(
+                lambda match: TOOLTIP_REPLACEMENTS[match.group(0)],
+                content
+            )
             
-            # Обновляем тултипы для конца сегмента
-            if "tooltip=f\"КОНЕЦ сегмента {i+1}\"" in content:
-                updated_content = updated_content.replace(
-                    "tooltip=f\"КОНЕЦ сегмента {i+1}\"", 
-                    "tooltip=f\"🔴 КОНЕЦ сегмента {i+1} | ⏱️ {time_str} | 📍[{lat:.6f}, {lon:.6f}] | 📋 {current_status}\""
-                )
-            elif "tooltip=f\"КОНЕЦ сегмента {i+1} | Статус:" in content:
-                updated_content = updated_content.replace(
-                    "tooltip=f\"КОНЕЦ сегмента {i+1} | Статус: {current_status}\"", 
-                    "tooltip=f\"🔴 КОНЕЦ сегмента {i+1} | ⏱️ {time_str} | 📍[{lat:.6f}, {lon:.6f}] | 📋 {current_status}\""
-                )
+            # Ни одна замена не сработала - не трогаем файл и его mtime
+            if updated_content == content:
+                logger.info("Тултипы уже в актуальном формате, файл не изменен")
+                return False
             
-            # Обновляем тултипы для начала и конца всего маршрута
-            if "tooltip=\"Начало маршрута\"," in content:
-                updated_content = updated_content.replace(
-                    "tooltip=\"Начало маршрута\",", 
-                    "tooltip=f\"🟢 Начало маршрута | ⏱️ {first_event[3]} | 📍[{lat:.6f}, {lon:.6f}]\","
-                )
-            if "tooltip=\"Конец маршрута\"," in content:
-                updated_content = updated_content.replace(
-                    "tooltip=\"Конец маршрута\",", 
-                    "tooltip=f\"🔴 Конец маршрута | ⏱️ {last_event[3]} | 📍[{lat:.6f}, {lon:.6f}]\","
-                )
-                
-            with open(file_path, 'w') as f:
-                f.write(updated_content)
+            # Метка в конце файла позволяет следующим запускам не сканировать его
+            if not updated_content.endswith("\n"):
+                updated_content += "\n"
+            file_path.write_text(updated_content + TOOLTIPS_SENTINEL + "\n", encoding='utf-8')
             
             logger.info("Отображение времени и координат в тултипах обновлено")
             return True
@@ -223,8 +312,19 @@ def main():
     update_result = update_tooltips_for_markers()
     
     # Добавляем дополнительные точки для обоих сегментов
-    seg1_result = add_location_points(user_id, session_id, 1)
-    seg2_result = add_location_points(user_id, session_id, 2)
+    # через одно соединение и одну транзакцию
+    conn = open_connection()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        seg1_result = add_location_points(user_id, session_id, 1, conn=conn)
+        seg2_result = add_location_points(user_id, session_id, 2, conn=conn)
+        
+        if seg1_result and seg2_result:
+            conn.execute("COMMIT")
+        else:
+            conn.execute("ROLLBACK")
+    finally:
+        conn.close()
     
     if seg1_result and seg2_result:
         logger.info("Успешно добавлены дополнительные точки для обоих сегментов")
@@ -9,7 +9,6 @@
 import os
 import sys
 import logging
-import subprocess
 import signal
 import time
 
@@ -56,22 +55,15 @@ def main():
         # Остановка существующего процесса бота
         kill_existing_bot()
         
-        # Запуск бота
-        logger.info("Запуск Telegram-бота...")
-        bot_process = subprocess.Popen(["python", "standalone_polling_bot.py"])
-        
-        # Сохранение PID
+        # Сохранение PID: после exec у бота тот же PID, что и у лаунчера
         with open("bot.pid", "w") as f:
-            f.write(str(bot_process.pid))
-        
-        logger.info(f"Telegram-бот запущен с PID: {bot_process.pid}")
-        
-        # Ожидание завершения процесса
-        bot_process.wait()
+            f.write(str(os.getpid()))
         
-        exit_code = bot_process.returncode
-        logger.info(f"Бот завершил работу с кодом: {exit_code}")
-        return exit_code
+        # Запуск бота на месте текущего процесса - лаунчер не остается
+        # висеть родителем и не ждет завершения бота. exec не возвращается
+        logger.info(f"Запуск Telegram-бота с PID: {os.getpid()}")
+        logging.shutdown()
+        os.execv(sys.executable, [sys.executable, "standalone_polling_bot.py"])
     
     except KeyboardInterrupt:
         logger.info("Получен сигнал прерывания, завершение работы")
@@ -12,6 +12,8 @@ import sys
 import time
 from threading import Thread
 
+import requests
+
 # Настройка логирования
 logging.basicConfig(
     level=logging.INFO,
@@ -24,11 +26,27 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+# Скрипт бота: по нему процесс узнается в /proc/PID/cmdline
+BOT_SCRIPT = "standalone_polling_bot.py"
+
 def check_process(pid):
-    """Проверяет, работает ли процесс с указанным PID."""
+    """Проверяет, что процесс с указанным PID работает и это именно бот.
+    
+    PID из bot.pid мог быть переиспользован другим процессом, поэтому
+    на Linux проверяется командная строка процесса, а не только его наличие.
+    """
     try:
-        os.kill(pid, 0)
-        return True
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            return BOT_SCRIPT.encode() in f.read()
+    except FileNotFoundError:
+        # Нет /proc (не Linux) - остается только проверка существования
+        if not os.path.isdir("/proc/self"):
+            try:
+                os.kill(pid, 0)
+                return True
+            except OSError:
+                return False
+        return False
     except OSError:
         return False
 
@@ -49,17 +67,20 @@ def get_saved_bot_pid():
 def run_bot():
     """Запускает Telegram-бота в фоновом режиме."""
     # Удаляем webhook перед запуском
+    # Один HTTP-запрос без запуска внешнего curl
     try:
-        subprocess.run(["curl", "-s", "-X", "POST", 
-                      f"https://api.telegram.org/bot{os.environ.get('TELEGRAM_TOKEN')}/deleteWebhook?drop_pending_updates=true"],
-                      capture_output=True)
+        requests.post(
+            f"https://api.telegram.org/bot{os.environ.get('TELEGRAM_TOKEN')}/deleteWebhook",
+            params={"drop_pending_updates": "true"},
+            timeout=5
+        )
         logger.info("Webhook deleted successfully")
     except Exception as e:
         logger.error(f"Error deleting webhook: {e}")
 
     # Запускаем бота
     try:
-        process = subprocess.Popen(["python", "standalone_polling_bot.py"], 
+        process = subprocess.Popen(["python", BOT_SCRIPT], 
                                  stdout=subprocess.PIPE, 
                                  stderr=subprocess.PIPE)
         logger.info(f"Bot started with PID: {process.pid}")
@@ -1,6 +1,7 @@
 """
-Скрипт для очистки геоданных и статусов определенного пользователя.
+Скрипт для очистки геоданных и статусов определенных пользователей.
 """
+import sys
 import sqlite3
 import logging
 from datetime import datetime
@@ -15,87 +16,87 @@ logger = logging.getLogger(__name__)
 # Путь к файлу базы данных
 DATABASE_FILE = "tracker.db"
 
-def clean_user_location_data(user_id):
-    """Очистить данные о местоположении пользователя"""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    
-    # Получаем количество записей о местоположении перед удалением
-    cursor.execute(
-        'SELECT COUNT(*) FROM location_history WHERE user_id = ?', 
-        (user_id,)
-    )
-    count_before = cursor.fetchone()[0]
-    
-    # Удаляем записи о местоположении
-    cursor.execute(
-        'DELETE FROM location_history WHERE user_id = ?', 
-        (user_id,)
-    )
-    
-    # Фиксируем изменения
-    conn.commit()
-    logger.info(f"Удалено {count_before} записей о местоположении пользователя {user_id}")
-    
-    conn.close()
-    return count_before
+# Пользователь, данные которого очищаются, если ID не переданы аргументами
+DEFAULT_USER_ID = 502488869
 
-def clean_user_status_data(user_id):
-    """Очистить данные о статусах пользователя"""
+# Те же индексы, что создает database.init_db: удаление по user_id
+# идет по левому столбцу индекса, а не полным просмотром таблицы
+HISTORY_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS ix_loc_user_ts ON location_history(user_id, timestamp)",
+    "CREATE INDEX IF NOT EXISTS ix_status_user_ts ON status_history(user_id, timestamp)",
+)
+
+def get_connection():
+    """Открыть одно соединение на весь запуск скрипта"""
     conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    
-    # Получаем количество записей о статусах перед удалением
-    cursor.execute(
-        'SELECT COUNT(*) FROM status_history WHERE user_id = ?', 
-        (user_id,)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    for statement in HISTORY_INDEXES:
+        conn.execute(statement)
+    return conn
+
+def _in_placeholders(values):
+    """Плейсхолдеры '?, ?, ...' для условия IN по списку значений"""
+    return ", ".join("?" * len(values))
+
+def clean_user_location_data(conn, user_ids):
+    """Очистить данные о местоположении пользователей одним DELETE"""
+    # rowcount у DELETE дает число удаленных записей без отдельного COUNT(*)
+    cursor = conn.execute(
+        f'DELETE FROM location_history WHERE user_id IN ({_in_placeholders(user_ids)})', 
+        user_ids
     )
-    count_before = cursor.fetchone()[0]
-    
-    # Удаляем записи о статусах
-    cursor.execute(
-        'DELETE FROM status_history WHERE user_id = ?', 
-        (user_id,)
+    logger.info(f"Удалено {cursor.rowcount} записей о местоположении пользователей {user_ids}")
+    return cursor.rowcount
+
+def clean_user_status_data(conn, user_ids):
+    """Очистить данные о статусах пользователей одним DELETE"""
+    cursor = conn.execute(
+        f'DELETE FROM status_history WHERE user_id IN ({_in_placeholders(user_ids)})', 
+        user_ids
     )
-    
-    # Фиксируем изменения
-    conn.commit()
-    logger.info(f"Удалено {count_before} записей о статусах пользователя {user_id}")
-    
-    conn.close()
-    return count_before
+    logger.info(f"Удалено {cursor.rowcount} записей о статусах пользователей {user_ids}")
+    return cursor.rowcount
 
-def get_user_name(user_id):
+def get_user_name(conn, user_id):
     """Получить имя пользователя по его ID"""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    
-    cursor.execute(
+    result = conn.execute(
         'SELECT full_name FROM user_mapping WHERE user_id = ?', 
         (user_id,)
-    )
-    result = cursor.fetchone()
-    conn.close()
+    ).fetchone()
     
     if result:
         return result[0]
     return f"User {user_id}"
 
 def main():
-    """Основная функция для очистки данных пользователя"""
-    # ID пользователя Копытина Андрея Владимировича
-    user_id = 502488869
-    user_name = get_user_name(user_id)
+    """Основная функция для очистки данных пользователей
+    
+    ID пользователей передаются аргументами командной строки:
+    python clean_user_data.py 502488869 123456789
+    """
+    # По умолчанию - пользователь Копытин Андрей Владимирович
+    try:
+        user_ids = [int(arg) for arg in sys.argv[1:]] or [DEFAULT_USER_ID]
+    except ValueError as e:
+        logger.error(f"Неверный ID пользователя: {e}")
+        return
     
-    logger.info(f"Начало очистки данных пользователя {user_name} (ID: {user_id})")
+    conn = get_connection()
+    user_names = [get_user_name(conn, user_id) for user_id in user_ids]
     
-    # Очистка данных о местоположении
-    locations_deleted = clean_user_location_data(user_id)
+    logger.info(f"Начало очистки данных пользователей: {', '.join(user_names)} (ID: {user_ids})")
     
-    # Очистка данных о статусах
-    statuses_deleted = clean_user_status_data(user_id)
+    # Обе очистки в одной транзакции - один commit вместо двух
+    with conn:
+        # Очистка данных о местоположении
+        locations_deleted = clean_user_location_data(conn, user_ids)
+        
+        # Очистка данных о статусах
+        statuses_deleted = clean_user_status_data(conn, user_ids)
+    conn.close()
     
-    logger.info(f"Очистка данных пользователя {user_name} завершена")
+    logger.info(f"Очистка данных пользователей {', '.join(user_names)} завершена")
     logger.info(f"Итого удалено: {locations_deleted} записей о местоположении, {statuses_deleted} записей о статусах")
 
 if __name__ == "__main__":
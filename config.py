@@ -1,6 +1,6 @@
 import os
 import logging
-import pytz
+from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -11,6 +11,10 @@ TOKEN = os.getenv("TELEGRAM_TOKEN") or os.getenv("TELEGRAM_BOT_TOKEN")
 BOT_MODE = os.getenv("BOT_MODE", "polling")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
 PORT = int(os.getenv("PORT", "5001"))
+# Число потоков диспетчера для обработчиков с run_async
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "16"))
+# Число отчетов (CSV + карта), которые строятся одновременно
+REPORT_WORKERS = int(os.getenv("REPORT_WORKERS", "2"))
 
 # Admin configuration
 ADMIN_ID = int(os.getenv("ADMIN_ID", "502488869"))  # Основной администратор
@@ -30,7 +34,7 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Moscow timezone
-MOSCOW_TZ = pytz.timezone('Europe/Moscow')
+MOSCOW_TZ = ZoneInfo('Europe/Moscow')
 
 # Установка серверного времени на московское для всех datetime.now()
 import time
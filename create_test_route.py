@@ -24,14 +24,30 @@ logger = logging.getLogger(__name__)
 # Подключение к БД
 DATABASE_FILE = 'tracker.db'
 
-def get_user_name(user_id):
+# Формат времени в истории местоположений и статусов
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+INSERT_LOCATION_SQL = (
+    "INSERT INTO location_history (user_id, latitude, longitude, timestamp, session_id, location_type) "
+    "VALUES (?, ?, ?, CAST(strftime('%s', ?) AS INTEGER), ?, ?)"
+)
+INSERT_STATUS_SQL = "INSERT INTO status_history (user_id, status, timestamp) VALUES (?, ?, ?)"
+
+# Случайное отклонение промежуточных точек, градусы
+JITTER_MIN = -0.0003
+JITTER_SPAN = 0.0006
+
+def get_connection():
+    """Открыть одно соединение на весь запуск скрипта"""
+    conn = sqlite3.connect(DATABASE_FILE)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+def get_user_name(conn, user_id):
     """Получить имя пользователя по ID"""
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        cursor.execute('SELECT full_name FROM user_mapping WHERE user_id = ?', (user_id,))
-        result = cursor.fetchone()
-        conn.close()
+        result = conn.execute('SELECT full_name FROM user_mapping WHERE user_id = ?', (user_id,)).fetchone()
         
         if result:
             return result[0]
@@ -42,76 +58,46 @@ def get_user_name(user_id):
 
 def create_path_between_points(start_point, end_point, num_points=3):
     """Создает промежуточные точки между двумя координатами"""
-    points = []
     start_lat, start_lon = start_point
     end_lat, end_lon = end_point
     
-    for i in range(num_points):
-        # Линейная интерполяция между точками
-        factor = (i + 1) / (num_points + 1)
-        lat = start_lat + (end_lat - start_lat) * factor
-        lon = start_lon + (end_lon - start_lon) * factor
-        
-        # Добавляем небольшое случайное отклонение для реалистичности (до 50 метров)
-        lat_deviation = random.uniform(-0.0003, 0.0003)
-        lon_deviation = random.uniform(-0.0003, 0.0003)
-        
-        points.append((lat + lat_deviation, lon + lon_deviation))
+    # Шаг линейной интерполяции считается один раз, а не для каждой точки
+    lat_step = (end_lat - start_lat) / (num_points + 1)
+    lon_step = (end_lon - start_lon) / (num_points + 1)
+    rand = random.random
     
-    return points
-
-def add_location_with_timestamp(user_id, latitude, longitude, timestamp, session_id, location_type):
-    """Добавляет местоположение с указанным временем"""
-    try:
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        
-        # Преобразуем timestamp в строку, если это объект datetime
-        if isinstance(timestamp, datetime):
-            timestamp_str = timestamp.strftime("%Y-%m-%d %H:%M:%S")
-        else:
-            timestamp_str = timestamp
-            
-        cursor.execute(
-            'INSERT INTO location_history (user_id, latitude, longitude, timestamp, session_id, location_type) VALUES (?, ?, ?, ?, ?, ?)',
-            (user_id, latitude, longitude, timestamp_str, session_id, location_type)
-        )
-        conn.commit()
-        conn.close()
-        return True
-    except Exception as e:
-        logger.error(f"Ошибка при добавлении местоположения: {e}")
-        return False
+    # Добавляем небольшое случайное отклонение для реалистичности (до 50 метров):
+    # random() * JITTER_SPAN + JITTER_MIN - тот же равномерный разброс, что
+    # uniform(-0.0003, 0.0003), без лишнего вызова функции на каждое значение
+    return [
+        (start_lat + lat_step * i + rand() * JITTER_SPAN + JITTER_MIN,
+         start_lon + lon_step * i + rand() * JITTER_SPAN + JITTER_MIN)
+        for i in range(1, num_points + 1)
+    ]
 
-def add_status_with_timestamp(user_id, status, timestamp):
-    """Добавляет статус с указанным временем"""
-    try:
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        
-        # Преобразуем timestamp в строку, если это объект datetime
-        if isinstance(timestamp, datetime):
-            timestamp_str = timestamp.strftime("%Y-%m-%d %H:%M:%S")
-        else:
-            timestamp_str = timestamp
-            
-        cursor.execute(
-            'INSERT INTO status_history (user_id, status, timestamp) VALUES (?, ?, ?)',
-            (user_id, status, timestamp_str)
-        )
-        conn.commit()
-        conn.close()
-        return True
-    except Exception as e:
-        logger.error(f"Ошибка при добавлении статуса: {e}")
-        return False
+def save_route(conn, location_rows, status_rows):
+    """Записывает все точки и статусы маршрута одной транзакцией
+    
+    Args:
+        conn: Соединение из get_connection
+        location_rows: Кортежи (user_id, latitude, longitude, timestamp, session_id, location_type)
+        status_rows: Кортежи (user_id, status, timestamp)
+    """
+    with conn:
+        conn.executemany(INSERT_LOCATION_SQL, location_rows)
+        conn.executemany(INSERT_STATUS_SQL, status_rows)
 
-def create_route_segment(user_id, start_point, end_point, start_time, session_id, 
+def create_route_segment(location_rows, user_id, start_point, end_point, start_time, session_id, 
                          start_type="intermediate", end_type="intermediate", points_between=3):
-    """Создает сегмент маршрута между двумя точками"""
+    """Создает сегмент маршрута между двумя точками
+    
+    Точки добавляются в location_rows и записываются в БД позже через save_route.
+    """
     # Добавляем начальную точку сегмента
     start_lat, start_lon = start_point
-    add_location_with_timestamp(user_id, start_lat, start_lon, start_time, session_id, start_type)
+    location_rows.append(
+        (user_id, start_lat, start_lon, start_time.strftime(TIMESTAMP_FORMAT), session_id, start_type)
+    )
     current_time = start_time
     
     # Создаем промежуточные точки
@@ -121,19 +107,28 @@ def create_route_segment(user_id, start_point, end_point, start_time, session_id
         for lat, lon in intermediate_points:
             # Увеличиваем время на случайный интервал (5-15 минут)
             current_time += timedelta(minutes=random.randint(5, 15))
-            add_location_with_timestamp(user_id, lat, lon, current_time, session_id, "intermediate")
-            logger.info(f"Добавлена промежуточная точка: ({lat:.6f}, {lon:.6f}) в {current_time}")
+            location_rows.append(
+                (user_id, lat, lon, current_time.strftime(TIMESTAMP_FORMAT), session_id, "intermediate")
+            )
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Добавлена промежуточная точка: (%.6f, %.6f) в %s", lat, lon, current_time)
+        
+        # Одна строка лога на сегмент вместо строки на каждую точку
+        logger.info("Добавлено %d промежуточных точек", len(intermediate_points))
     
     # Добавляем конечную точку сегмента
     current_time += timedelta(minutes=random.randint(5, 15))
     end_lat, end_lon = end_point
-    add_location_with_timestamp(user_id, end_lat, end_lon, current_time, session_id, end_type)
+    location_rows.append(
+        (user_id, end_lat, end_lon, current_time.strftime(TIMESTAMP_FORMAT), session_id, end_type)
+    )
     
     return current_time
 
 def create_test_route(user_id):
     """Создает тестовый маршрут для пользователя"""
-    user_name = get_user_name(user_id)
+    conn = get_connection()
+    user_name = get_user_name(conn, user_id)
     logger.info(f"Создание тестового маршрута для {user_name} (ID: {user_id})")
     
     # Текущая дата/время минус 6 часов для начала
@@ -162,13 +157,18 @@ def create_test_route(user_id):
     ]
     
     # Добавляем статусы
+    status_rows = []
     for status, timestamp in statuses:
-        add_status_with_timestamp(user_id, status, timestamp)
+        status_rows.append((user_id, status, timestamp.strftime(TIMESTAMP_FORMAT)))
         logger.info(f"Добавлен статус: {status} в {timestamp}")
     
+    # Точки всех сегментов копятся здесь и записываются в конце
+    location_rows = []
+    
     # Создаем первый сегмент: Дом -> Метро (начальная точка маршрута)
     current_time = start_time
     current_time = create_route_segment(
+        location_rows,
         user_id, 
         route_points[0][0], 
         route_points[1][0], 
@@ -181,6 +181,7 @@ def create_test_route(user_id):
     
     # Метро -> Работа
     current_time = create_route_segment(
+        location_rows,
         user_id, 
         route_points[1][0], 
         route_points[2][0], 
@@ -191,6 +192,7 @@ def create_test_route(user_id):
     
     # Работа -> Обед
     current_time = create_route_segment(
+        location_rows,
         user_id, 
         route_points[2][0], 
         route_points[3][0], 
@@ -201,6 +203,7 @@ def create_test_route(user_id):
     
     # Обед -> Работа
     current_time = create_route_segment(
+        location_rows,
         user_id, 
         route_points[3][0], 
         route_points[4][0], 
@@ -211,6 +214,7 @@ def create_test_route(user_id):
     
     # Работа -> Метро
     current_time = create_route_segment(
+        location_rows,
         user_id, 
         route_points[4][0], 
         route_points[5][0], 
@@ -221,6 +225,7 @@ def create_test_route(user_id):
     
     # Метро -> Дом (конечная точка маршрута)
     current_time = create_route_segment(
+        location_rows,
         user_id, 
         route_points[5][0], 
         route_points[6][0], 
@@ -231,6 +236,12 @@ def create_test_route(user_id):
     )
     logger.info(f"Добавлен сегмент: {route_points[5][1]} -> {route_points[6][1]}")
     
+    try:
+        save_route(conn, location_rows, status_rows)
+    finally:
+        conn.close()
+    logger.info(f"Записано {len(location_rows)} точек и {len(status_rows)} статусов")
+    
     return session_id
 
 def main():
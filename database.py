@@ -1,13 +1,217 @@
 import sqlite3
 import logging
+import threading
+import time
+from calendar import timegm
+from collections import namedtuple
 from datetime import datetime, timedelta
 from config import DATABASE_FILE, MOSCOW_TZ, MAX_LOCATION_AGE_HOURS
 
 logger = logging.getLogger(__name__)
 
+# Буфер точек живой геолокации: вместо INSERT на каждое обновление
+# точки копятся в памяти и записываются одной транзакцией
+LOCATION_BUFFER_MAX = 100
+_location_buffer = []
+_location_buffer_lock = threading.Lock()
+
+# Буфер сбрасывает отдельный поток записи: обработчик обновления только
+# кладет точку в память и не ждет fsync. Поток просыпается по интервалу
+# или сразу, когда буфер заполнен
+LOCATION_FLUSH_INTERVAL = 2  # секунды
+_location_flush_event = threading.Event()
+_location_writer_stop = threading.Event()
+_location_writer = None
+
+# Одно постоянное соединение для записи на горячем пути (геолокация, статусы):
+# без повторного открытия файла на каждый вызов. Диспетчер бота работает
+# в нескольких потоках, поэтому доступ сериализуется блокировкой
+WRITE_PRAGMAS = (
+    # Размер страницы применяется только к еще пустому файлу базы (до перехода
+    # в WAL); на существующей базе SQLite его молча игнорирует
+    "PRAGMA page_size=8192",
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+)
+_write_conn = None
+_write_lock = threading.RLock()
+
+# Кэш подготовленных запросов sqlite3 на соединение (по умолчанию 128):
+# соединения живут весь процесс, и запросы горячего пути не разбираются заново
+CACHED_STATEMENTS = 256
+
+def get_write_connection():
+    """Вернуть общее соединение для записи, открыв его при первом обращении
+    
+    Вызывать только под _write_lock.
+    """
+    global _write_conn
+    if _write_conn is None:
+        _write_conn = sqlite3.connect(
+            DATABASE_FILE, check_same_thread=False, cached_statements=CACHED_STATEMENTS
+        )
+        for pragma in WRITE_PRAGMAS:
+            _write_conn.execute(pragma)
+    return _write_conn
+
+def close_write_connection():
+    """Закрыть общее соединение для записи (при остановке бота)"""
+    global _write_conn
+    with _write_lock:
+        if _write_conn is not None:
+            _write_conn.close()
+            _write_conn = None
+
+# Соединения для чтения: по одному на поток диспетчера/планировщика,
+# открываются при первом запросе и живут до остановки бота. В режиме WAL
+# чтение не блокирует запись через общее соединение
+READ_PRAGMAS = (
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-20000",
+    # Диапазонные выборки истории читают страницы через отображение файла (256 МБ),
+    # а не отдельным read() на каждую страницу
+    "PRAGMA mmap_size=268435456",
+)
+_read_local = threading.local()
+_read_conns = []
+_read_conns_lock = threading.Lock()
+
+def get_read_connection():
+    """Вернуть соединение для чтения текущего потока, открыв его при первом обращении"""
+    conn = getattr(_read_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(
+            DATABASE_FILE, check_same_thread=False, cached_statements=CACHED_STATEMENTS
+        )
+        for pragma in READ_PRAGMAS:
+            conn.execute(pragma)
+        _read_local.conn = conn
+        with _read_conns_lock:
+            _read_conns.append(conn)
+    return conn
+
+def close_read_connections():
+    """Закрыть соединения для чтения всех потоков (при остановке бота)"""
+    with _read_conns_lock:
+        for conn in _read_conns:
+            conn.close()
+        _read_conns.clear()
+
+# Версия схемы в PRAGMA user_version: увеличивать при изменении _create_tables,
+# иначе на существующей базе новые таблицы и индексы не будут созданы
+SCHEMA_VERSION = 6
+
 def init_db():
-    """Initialize the database with required tables if they don't exist"""
-    conn = sqlite3.connect(DATABASE_FILE)
+    """Initialize the database with required tables if they don't exist
+    
+    WAL и synchronous=NORMAL включаются при открытии соединения для записи
+    (WRITE_PRAGMAS), DDL выполняется, только если схема базы устарела.
+    """
+    with _write_lock:
+        conn = get_write_connection()
+        user_version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if user_version < SCHEMA_VERSION:
+            _migrate_tables(conn)
+            _create_tables(conn)
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    
+    logger.info("Database initialized")
+
+# Горячие таблицы истории без AUTOINCREMENT: INTEGER PRIMARY KEY и так
+# выдает новые id, а AUTOINCREMENT добавляет запись в sqlite_sequence на каждый INSERT
+STATUS_HISTORY_DDL = '''
+    CREATE TABLE IF NOT EXISTS status_history (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        status TEXT,
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES user_mapping(user_id)
+    )
+'''
+
+# timestamp в истории геолокации — секунды unix epoch (UTC): сравнения
+# диапазонов идут по целым числам, а строки не нужно разбирать при чтении
+LOCATION_HISTORY_DDL = '''
+    CREATE TABLE IF NOT EXISTS location_history (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        latitude REAL,
+        longitude REAL,
+        timestamp INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+        session_id TEXT,
+        location_type TEXT DEFAULT 'intermediate',  -- 'start', 'intermediate', 'end'
+        FOREIGN KEY (user_id) REFERENCES user_mapping(user_id)
+    )
+'''
+
+# Утренняя проверка ищется только по (user_id, check_date), поэтому этот ключ
+# и есть первичный: WITHOUT ROWID хранит строки прямо в его B-дереве
+MORNING_CHECKS_DDL = '''
+    CREATE TABLE IF NOT EXISTS morning_checks (
+        user_id INTEGER,
+        check_date TEXT,
+        checked_in BOOLEAN DEFAULT 0,
+        notified BOOLEAN DEFAULT 0,
+        admin_notified BOOLEAN DEFAULT 0,
+        PRIMARY KEY (user_id, check_date),
+        FOREIGN KEY (user_id) REFERENCES user_mapping(user_id)
+    ) WITHOUT ROWID
+'''
+
+def _table_sql(conn, table):
+    """DDL существующей таблицы из sqlite_master или None, если таблицы нет"""
+    row = conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    ).fetchone()
+    return row[0] if row else None
+
+def _rebuild_table(conn, table, ddl, columns, select_columns=None):
+    """Пересоздать таблицу по новому DDL, скопировав данные одной транзакцией
+    
+    SQLite не меняет тип, значение по умолчанию и первичный ключ у существующей
+    таблицы. Индексы старой таблицы удаляются вместе с ней и создаются
+    заново в _create_tables.
+    """
+    with conn:
+        conn.execute("BEGIN")
+        conn.execute(f"ALTER TABLE {table} RENAME TO {table}_old")
+        conn.execute(ddl)
+        conn.execute(
+            f"INSERT OR IGNORE INTO {table} ({', '.join(columns)}) "
+            f"SELECT {', '.join(select_columns or columns)} FROM {table}_old"
+        )
+        conn.execute(f"DROP TABLE {table}_old")
+    logger.info(f"Таблица {table} пересоздана по текущей схеме")
+
+def _migrate_tables(conn):
+    """Привести таблицы существующей базы к текущему DDL"""
+    location_sql = _table_sql(conn, 'location_history')
+    if location_sql and ('AUTOINCREMENT' in location_sql or 'timestamp INTEGER' not in location_sql):
+        # Текстовые timestamp переводятся в unix epoch, уже целые копируются как есть
+        _rebuild_table(
+            conn, 'location_history', LOCATION_HISTORY_DDL,
+            ('id', 'user_id', 'latitude', 'longitude', 'timestamp', 'session_id', 'location_type'),
+            ('id', 'user_id', 'latitude', 'longitude',
+             "CASE WHEN typeof(timestamp) = 'text' "
+             "THEN CAST(strftime('%s', timestamp) AS INTEGER) ELSE timestamp END",
+             'session_id', 'location_type'),
+        )
+    
+    status_sql = _table_sql(conn, 'status_history')
+    if status_sql and 'AUTOINCREMENT' in status_sql:
+        _rebuild_table(conn, 'status_history', STATUS_HISTORY_DDL, ('id', 'user_id', 'status', 'timestamp'))
+    
+    morning_sql = _table_sql(conn, 'morning_checks')
+    if morning_sql and 'WITHOUT ROWID' not in morning_sql:
+        _rebuild_table(
+            conn, 'morning_checks', MORNING_CHECKS_DDL,
+            ('user_id', 'check_date', 'checked_in', 'notified', 'admin_notified'),
+        )
+
+def _create_tables(conn):
+    """Создать таблицы, если их еще нет"""
     cursor = conn.cursor()
     
     # User information table
@@ -21,43 +225,13 @@ def init_db():
     ''')
     
     # Status history table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS status_history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            status TEXT,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES user_mapping(user_id)
-        )
-    ''')
+    cursor.execute(STATUS_HISTORY_DDL)
     
     # Location tracking table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS location_history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            latitude REAL,
-            longitude REAL,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            session_id TEXT,
-            location_type TEXT DEFAULT 'intermediate',  -- 'start', 'intermediate', 'end'
-            FOREIGN KEY (user_id) REFERENCES user_mapping(user_id)
-        )
-    ''')
+    cursor.execute(LOCATION_HISTORY_DDL)
     
     # Morning check table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS morning_checks (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            check_date TEXT,
-            checked_in BOOLEAN DEFAULT 0,
-            notified BOOLEAN DEFAULT 0,
-            admin_notified BOOLEAN DEFAULT 0,
-            FOREIGN KEY (user_id) REFERENCES user_mapping(user_id),
-            UNIQUE(user_id, check_date)
-        )
-    ''')
+    cursor.execute(MORNING_CHECKS_DDL)
     
     # Night shift schedule table
     cursor.execute('''
@@ -85,10 +259,34 @@ def init_db():
         )
     ''')
     
+    # Выборки истории идут по пользователю и времени
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS ix_loc_user_ts ON location_history(user_id, timestamp)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS ix_status_user_ts ON status_history(user_id, timestamp)
+    ''')
+    # Точки одной сессии по времени: get_user_locations(session_id=...),
+    # завершение сессий и поиск последней точки без сортировки
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS ix_loc_user_session_ts ON location_history(user_id, session_id, timestamp)
+    ''')
+    # Только незавершенные точки: поиск активной сессии (условие
+    # location_type != 'end' должно совпадать с запросами, иначе индекс не выбирается)
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS ix_loc_open_user_ts ON location_history(user_id, timestamp)
+        WHERE location_type != 'end'
+    ''')
+    # Статистика отгулов по пользователю за период
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS ix_timeoff_user_time ON timeoff_requests(user_id, request_time)
+    ''')
+    
     conn.commit()
-    conn.close()
     
-    logger.info("Database initialized")
+    # Статистика распределения значений для планировщика запросов,
+    # чтобы новые индексы выбирались и на уже заполненных таблицах
+    cursor.execute('ANALYZE')
 
 def get_user_locations(user_id, hours_limit=MAX_LOCATION_AGE_HOURS, session_id=None, date=None):
     """Get location history for a specific user
@@ -99,12 +297,11 @@ def get_user_locations(user_id, hours_limit=MAX_LOCATION_AGE_HOURS, session_id=N
         session_id: If provided, only return locations from this session
         date: Если указана дата в формате 'YYYY-MM-DD', возвращать данные только за этот день
     """
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
+    conn = get_read_connection()
     
     if session_id:
         # Get locations from a specific session
-        cursor.execute('''
+        cursor = conn.execute('''
             SELECT id, latitude, longitude, timestamp, location_type
             FROM location_history 
             WHERE user_id = ? AND session_id = ? 
@@ -112,47 +309,138 @@ def get_user_locations(user_id, hours_limit=MAX_LOCATION_AGE_HOURS, session_id=N
         ''', (user_id, session_id))
     elif date:
         # Get locations for a specific date
-        date_start = f"{date} 00:00:00"
-        date_end = f"{date} 23:59:59"
-        
-        cursor.execute('''
+        cursor = conn.execute('''
             SELECT id, latitude, longitude, timestamp, location_type
             FROM location_history 
-            WHERE user_id = ? AND timestamp BETWEEN ? AND ?
+            WHERE user_id = ? AND timestamp >= ? AND timestamp < ?
             ORDER BY timestamp
-        ''', (user_id, date_start, date_end))
+        ''', (user_id, *_day_range(date)))
     else:
         # Get all recent locations
         # Calculate the time limit
-        time_limit = datetime.now(MOSCOW_TZ) - timedelta(hours=hours_limit)
-        time_limit_str = time_limit.strftime('%Y-%m-%d %H:%M:%S')
+        time_limit = _to_epoch(datetime.now(MOSCOW_TZ) - timedelta(hours=hours_limit))
         
-        cursor.execute('''
+        cursor = conn.execute('''
             SELECT id, latitude, longitude, timestamp, location_type
             FROM location_history 
             WHERE user_id = ? AND timestamp > ? 
             ORDER BY timestamp
-        ''', (user_id, time_limit_str))
+        ''', (user_id, time_limit))
     
     locations = cursor.fetchall()
     
-    # Convert timestamp strings to datetime objects if they are strings
-    processed_locations = []
-    for loc in locations:
-        loc_id, lat, lon, ts, loc_type = loc
-        if isinstance(ts, str):
-            try:
-                ts = datetime.strptime(ts, '%Y-%m-%d %H:%M:%S')
-            except ValueError:
-                try:
-                    ts = datetime.strptime(ts, '%Y-%m-%d %H:%M:%S.%f')
-                except Exception as e:
-                    logger.error(f"Error parsing timestamp: {e}, timestamp: {ts}")
-                    continue
-        processed_locations.append((loc_id, lat, lon, ts, loc_type))
-    
-    conn.close()
-    return processed_locations
+    return _process_location_rows(locations)
+
+_EPOCH = datetime(1970, 1, 1)
+
+def _to_epoch(dt):
+    """Секунды unix epoch по показаниям часов dt, как strftime('%s') для строки
+    
+    Часовой пояс dt не учитывается: границы совпадают с прежним сравнением
+    строки '%Y-%m-%d %H:%M:%S' с текстовым timestamp.
+    """
+    return timegm(dt.timetuple())
+
+def _from_epoch(ts):
+    """Наивный datetime (UTC) из секунд unix epoch; None остается None"""
+    if ts is None:
+        return None
+    return _EPOCH + timedelta(seconds=ts)
+
+def _day_range(date):
+    """Границы суток [date, следующий день) в секундах unix epoch
+    
+    Условие timestamp >= начало AND timestamp < конец идет по индексу
+    (user_id, timestamp) и сравнивает целые числа.
+    """
+    start = datetime.fromisoformat(date)
+    return _to_epoch(start), _to_epoch(start + timedelta(days=1))
+
+# Запросы горячего пути (на каждую точку геолокации и смену статуса)
+_SQL_INSERT_LOCATION = '''
+    INSERT INTO location_history (user_id, latitude, longitude, timestamp, session_id, location_type)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+_SQL_INSERT_LOCATION_TODAY_SESSION = '''
+    INSERT INTO location_history (user_id, latitude, longitude, timestamp, session_id, location_type)
+    SELECT ?, ?, ?, ?, COALESCE((
+        SELECT session_id FROM location_history
+        WHERE user_id = ? AND timestamp >= ? AND timestamp < ? AND location_type != 'end'
+        ORDER BY timestamp DESC LIMIT 1
+    ), ?), ?
+    RETURNING session_id
+'''
+
+# Индекс ix_loc_user_ts позволяет взять последнюю точку без сортировки
+_SQL_LATEST_LOCATION = '''
+    SELECT id, latitude, longitude, timestamp, location_type
+    FROM location_history 
+    WHERE user_id = ? AND timestamp > ? 
+    ORDER BY timestamp DESC
+    LIMIT 1
+'''
+
+_SQL_INSERT_STATUS = '''
+    INSERT INTO status_history (user_id, status)
+    VALUES (?, ?)
+'''
+
+# Строка истории геолокации в едином виде: вызывающему коду не нужно
+# угадывать формат кортежа по его длине
+LocationRow = namedtuple('LocationRow', 'id latitude longitude timestamp location_type')
+
+# Точка отчета за день: вместо id нужна сессия, к которой она относится
+DayLocationRow = namedtuple('DayLocationRow', 'latitude longitude timestamp session_id location_type')
+
+def _process_location_rows(locations):
+    """Convert epoch timestamps to naive UTC datetimes
+    
+    Rows are (id, latitude, longitude, timestamp, location_type) and are
+    returned as LocationRow.
+    """
+    return [
+        LocationRow(loc_id, lat, lon, _from_epoch(ts), loc_type)
+        for loc_id, lat, lon, ts, loc_type in locations
+    ]
+
+def get_latest_user_location(user_id, hours_limit=MAX_LOCATION_AGE_HOURS):
+    """Get the most recent location of a user without loading the whole history
+    
+    Args:
+        user_id: Telegram user ID
+        hours_limit: How many hours back to look for a location
+    
+    Returns:
+        LocationRow as in get_user_locations, or None if there is no
+        location in the window
+    """
+    # Самая свежая точка может быть еще в буфере
+    flush_location_buffer()
+    
+    time_limit = _to_epoch(datetime.now(MOSCOW_TZ) - timedelta(hours=hours_limit))
+    
+    row = get_read_connection().execute(_SQL_LATEST_LOCATION, (user_id, time_limit)).fetchone()
+    
+    processed = _process_location_rows([row]) if row else []
+    return processed[0] if processed else None
+
+# Активная сессия пользователя за сегодня: user_id -> (дата, session_id).
+# Точки одной трансляции идут подряд, поэтому поиск сессии в БД нужен только
+# на первой точке дня и после завершения сессии (mark_session_ended сбрасывает запись)
+ACTIVE_SESSION_CACHE_MAX = 1000
+_active_sessions = {}
+
+def _remember_active_session(user_id, date, session_id):
+    """Запомнить активную сессию пользователя; вызывать под _write_lock"""
+    if len(_active_sessions) >= ACTIVE_SESSION_CACHE_MAX and user_id not in _active_sessions:
+        _active_sessions.clear()
+    _active_sessions[user_id] = (date, session_id)
+
+def _forget_active_session(user_id):
+    """Сбросить активную сессию пользователя из кэша"""
+    with _write_lock:
+        _active_sessions.pop(user_id, None)
 
 def save_location(user_id, latitude, longitude, session_id=None, location_type='intermediate'):
     """Save a new location for a user
@@ -164,48 +452,147 @@ def save_location(user_id, latitude, longitude, session_id=None, location_type='
         session_id: Session ID for tracking a sequence of locations (optional)
         location_type: One of 'start', 'intermediate', 'end' (default: 'intermediate')
     """
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    
-    # If session_id not provided, generate one
-    if not session_id:
-        # Check if there's an active session from today
-        today = datetime.now(MOSCOW_TZ).strftime('%Y-%m-%d')
-        cursor.execute('''
-            SELECT session_id FROM location_history 
-            WHERE user_id = ? AND timestamp LIKE ? AND location_type != 'end' 
-            ORDER BY timestamp DESC LIMIT 1
-        ''', (user_id, f"{today}%"))
+    timestamp = current_utc_timestamp()
+    today = datetime.now(MOSCOW_TZ).strftime('%Y-%m-%d')
+    with _write_lock:
+        if not session_id:
+            cached = _active_sessions.get(user_id)
+            if cached and cached[0] == today:
+                session_id = cached[1]
         
-        result = cursor.fetchone()
-        if result:
-            session_id = result[0]
+        if session_id:
+            save_locations_bulk([(user_id, latitude, longitude, timestamp, session_id, location_type)])
         else:
-            # Create new session ID based on timestamp
-            session_id = f"session_{user_id}_{int(datetime.now().timestamp())}"
+            # Поиск активной сессии за сегодня и вставка точки — одним оператором:
+            # если сессии нет, COALESCE подставляет новый ID на основе текущего времени
+            new_session_id = f"session_{user_id}_{int(datetime.now().timestamp())}"
+            conn = get_write_connection()
+            with conn:
+                row = conn.execute(_SQL_INSERT_LOCATION_TODAY_SESSION, (user_id, latitude, longitude, timestamp,
+                      user_id, *_day_range(today), new_session_id, location_type)).fetchone()
+            session_id = row[0]
+        
+        if location_type == 'end':
+            _active_sessions.pop(user_id, None)
+        else:
+            _remember_active_session(user_id, today, session_id)
+    return session_id
+
+def save_locations_bulk(rows):
+    """Записать пачку точек одним executemany в одной транзакции
     
-    cursor.execute('''
-        INSERT INTO location_history (user_id, latitude, longitude, session_id, location_type)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (user_id, latitude, longitude, session_id, location_type))
+    Args:
+        rows: Кортежи (user_id, latitude, longitude, timestamp, session_id, location_type),
+            timestamp — секунды unix epoch (UTC)
     
-    conn.commit()
-    conn.close()
-    return session_id
+    Returns:
+        Количество записанных точек
+    """
+    rows = list(rows)
+    if not rows:
+        return 0
+    with _write_lock:
+        conn = get_write_connection()
+        with conn:
+            conn.executemany(_SQL_INSERT_LOCATION, rows)
+    return len(rows)
+
+def current_utc_timestamp():
+    """Текущее время в секундах unix epoch (UTC) для столбца location_history.timestamp"""
+    return int(time.time())
+
+def buffer_location(user_id, latitude, longitude, session_id, location_type='intermediate'):
+    """Добавить точку существующей сессии в буфер записи
+    
+    Время фиксируется в момент получения точки (секунды unix epoch),
+    поэтому отложенная запись не сдвигает точки на маршруте.
+    Буфер сбрасывается в БД при заполнении или задачей по расписанию.
+    """
+    timestamp = current_utc_timestamp()
+    with _location_buffer_lock:
+        _location_buffer.append((user_id, latitude, longitude, timestamp, session_id, location_type))
+        should_flush = len(_location_buffer) >= LOCATION_BUFFER_MAX
+    
+    if should_flush:
+        if _location_writer is not None:
+            _location_flush_event.set()
+        else:
+            # Без потока записи (скрипты, тесты) сбрасываем сразу
+            flush_location_buffer()
+
+def flush_location_buffer():
+    """Записать все накопленные точки одним executemany в одной транзакции
+    
+    Returns:
+        Количество записанных точек
+    """
+    global _location_buffer
+    with _location_buffer_lock:
+        if not _location_buffer:
+            return 0
+        rows, _location_buffer = _location_buffer, []
+    
+    try:
+        save_locations_bulk(rows)
+        logger.debug(f"Записано {len(rows)} точек геолокации из буфера")
+        return len(rows)
+    except Exception as e:
+        # Возвращаем точки в начало буфера, чтобы не потерять их до следующей попытки
+        logger.error(f"Ошибка записи буфера геолокации: {e}")
+        with _location_buffer_lock:
+            _location_buffer[:0] = rows
+        return 0
+
+def _location_writer_loop():
+    """Цикл потока записи: сбрасывать буфер по интервалу или по сигналу"""
+    while not _location_writer_stop.is_set():
+        _location_flush_event.wait(LOCATION_FLUSH_INTERVAL)
+        _location_flush_event.clear()
+        flush_location_buffer()
+
+def start_location_writer():
+    """Запустить поток записи буфера геолокации (один на процесс)"""
+    global _location_writer
+    if _location_writer is not None:
+        return
+    _location_writer_stop.clear()
+    _location_writer = threading.Thread(
+        target=_location_writer_loop, name="location-writer", daemon=True
+    )
+    _location_writer.start()
+
+def stop_location_writer():
+    """Остановить поток записи и записать точки, оставшиеся в буфере"""
+    global _location_writer
+    if _location_writer is not None:
+        _location_writer_stop.set()
+        _location_flush_event.set()
+        _location_writer.join()
+        _location_writer = None
+    flush_location_buffer()
 
 def save_status(user_id, status):
     """Save a new status for a user"""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
+    save_statuses_bulk([(user_id, status)])
+    return True
+
+def save_statuses_bulk(rows):
+    """Записать пачку статусов одним executemany в одной транзакции
     
-    cursor.execute('''
-        INSERT INTO status_history (user_id, status)
-        VALUES (?, ?)
-    ''', (user_id, status))
+    Args:
+        rows: Кортежи (user_id, status); время ставит CURRENT_TIMESTAMP
     
-    conn.commit()
-    conn.close()
-    return True
+    Returns:
+        Количество записанных статусов
+    """
+    rows = list(rows)
+    if not rows:
+        return 0
+    with _write_lock:
+        conn = get_write_connection()
+        with conn:
+            conn.executemany(_SQL_INSERT_STATUS, rows)
+    return len(rows)
 
 def get_user_status_history(user_id, date=None, days=1):
     """Get status history for a specific user
@@ -216,10 +603,10 @@ def get_user_status_history(user_id, date=None, days=1):
         days: Количество дней, за которые нужны данные (если date не указан)
     
     Returns:
-        Список кортежей (status, timestamp) в порядке возрастания времени (сначала старые)
+        Список кортежей (status, timestamp) в порядке возрастания времени (сначала старые),
+        timestamp — наивный datetime в UTC
     """
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
+    conn = get_read_connection()
     
     if date:
         # Get status updates for a specific date
@@ -227,8 +614,8 @@ def get_user_status_history(user_id, date=None, days=1):
         date_start = f"{date} 00:00:00"
         date_end = f"{date} 23:59:59"
         
-        cursor.execute('''
-            SELECT status, timestamp
+        cursor = conn.execute('''
+            SELECT status, CAST(strftime('%s', timestamp) AS INTEGER)
             FROM status_history
             WHERE user_id = ? AND timestamp BETWEEN ? AND ?
             ORDER BY timestamp ASC
@@ -238,16 +625,16 @@ def get_user_status_history(user_id, date=None, days=1):
         time_limit = datetime.now(MOSCOW_TZ) - timedelta(days=days)
         time_limit_str = time_limit.strftime('%Y-%m-%d %H:%M:%S')
         
-        cursor.execute('''
-            SELECT status, timestamp 
+        cursor = conn.execute('''
+            SELECT status, CAST(strftime('%s', timestamp) AS INTEGER)
             FROM status_history 
             WHERE user_id = ? AND timestamp > ? 
             ORDER BY timestamp ASC
         ''', (user_id, time_limit_str))
     
-    status_history = cursor.fetchall()
-    conn.close()
-    return status_history
+    # Текстовый timestamp разбирает SQLite (strftime('%s')), в Python
+    # остается перевести секунды в datetime без разбора строк
+    return [(status, _from_epoch(ts)) for status, ts in cursor.fetchall()]
 
 def get_user_latest_status(user_id):
     """Получить самый последний статус пользователя
@@ -258,10 +645,9 @@ def get_user_latest_status(user_id):
     Returns:
         Кортеж (status, timestamp) или None, если статус не найден
     """
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
+    conn = get_read_connection()
     
-    cursor.execute('''
+    cursor = conn.execute('''
         SELECT status, timestamp 
         FROM status_history 
         WHERE user_id = ? 
@@ -270,28 +656,29 @@ def get_user_latest_status(user_id):
     ''', (user_id,))
     
     status = cursor.fetchone()
-    conn.close()
     
     return status
 
 def get_all_users_with_latest_status():
     """Get all users with their latest status"""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
+    conn = get_read_connection()
     
-    cursor.execute('''
+    # Последний статус берется коррелированным подзапросом по индексу
+    # ix_status_user_ts: один поиск на пользователя вместо сортировки
+    # всей status_history оконной функцией
+    cursor = conn.execute('''
         SELECT um.user_id, um.full_name, sh.status, sh.timestamp
         FROM user_mapping um
-        LEFT JOIN (
-            SELECT user_id, status, timestamp,
-                  ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY timestamp DESC) as rn
-            FROM status_history
-        ) sh ON um.user_id = sh.user_id AND sh.rn = 1
+        LEFT JOIN status_history sh ON sh.id = (
+            SELECT id FROM status_history
+            WHERE user_id = um.user_id
+            ORDER BY timestamp DESC
+            LIMIT 1
+        )
         ORDER BY um.full_name
     ''')
     
     users = cursor.fetchall()
-    conn.close()
     return users
 
 def get_today_locations_for_user(user_id, date=None):
@@ -302,89 +689,133 @@ def get_today_locations_for_user(user_id, date=None):
         date: Дата в формате строки 'YYYY-MM-DD', если None - используется сегодняшняя дата
         
     Returns:
-        Список кортежей (latitude, longitude, timestamp, session_id, location_type)
+        Список DayLocationRow (latitude, longitude, timestamp, session_id,
+        location_type), timestamp — наивный datetime в UTC
     """
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
+    conn = get_read_connection()
     
     # Get date in Moscow timezone
     if date is None:
         date = datetime.now(MOSCOW_TZ).strftime('%Y-%m-%d')
     
-    cursor.execute('''
+    cursor = conn.execute('''
         SELECT latitude, longitude, timestamp, session_id, location_type
         FROM location_history 
-        WHERE user_id = ? AND timestamp LIKE ? 
+        WHERE user_id = ? AND timestamp >= ? AND timestamp < ? 
         ORDER BY timestamp
-    ''', (user_id, f"{date}%"))
+    ''', (user_id, *_day_range(date)))
     
-    locations = cursor.fetchall()
-    conn.close()
-    return locations
+    return [
+        DayLocationRow(lat, lon, _from_epoch(ts), session_id, loc_type)
+        for lat, lon, ts, session_id, loc_type in cursor.fetchall()
+    ]
 
 def get_active_location_sessions(user_id):
     """Get all active location sessions for a user"""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
+    # Точки из буфера должны быть видны при поиске активных сессий
+    flush_location_buffer()
+    
+    conn = get_read_connection()
     
     # Get today's date in Moscow timezone
     today = datetime.now(MOSCOW_TZ).strftime('%Y-%m-%d')
     
-    cursor.execute('''
-        SELECT DISTINCT session_id
+    # GROUP BY вместо DISTINCT: сессии упорядочены по последней точке
+    # однозначно, без отдельной сортировки для устранения дублей
+    cursor = conn.execute('''
+        SELECT session_id, MAX(timestamp) AS last_ts
         FROM location_history 
-        WHERE user_id = ? AND timestamp LIKE ? AND location_type != 'end'
-        ORDER BY timestamp DESC
-    ''', (user_id, f"{today}%"))
+        WHERE user_id = ? AND timestamp >= ? AND timestamp < ? AND location_type != 'end'
+        GROUP BY session_id
+        ORDER BY last_ts DESC
+    ''', (user_id, *_day_range(today)))
     
     sessions = cursor.fetchall()
-    conn.close()
     return [s[0] for s in sessions]
 
-def mark_session_ended(session_id, user_id, latitude=None, longitude=None):
-    """Mark a location session as ended
+def mark_all_sessions_ended(user_id):
+    """Mark all of the user's active sessions from today as ended in one UPDATE
     
-    If latitude and longitude are provided, adds a final location point
-    with location_type='end'. Otherwise, just marks the last point as 'end'.
+    The most recent point of every such session becomes an 'end' point,
+    as mark_session_ended does for a single session.
+    
+    Returns:
+        Number of sessions that were closed
     """
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
+    # Последние точки сессий могут быть еще в буфере
+    flush_location_buffer()
+    _forget_active_session(user_id)
     
-    try:
-        if latitude and longitude:
-            # Add a final location point
-            cursor.execute('''
-                INSERT INTO location_history (user_id, latitude, longitude, session_id, location_type)
-                VALUES (?, ?, ?, ?, 'end')
-            ''', (user_id, latitude, longitude, session_id))
-            logger.info(f"Added end location point for session {session_id}")
-        else:
-            # Check if the session exists
-            cursor.execute('''
-                SELECT COUNT(*) FROM location_history
-                WHERE user_id = ? AND session_id = ?
-            ''', (user_id, session_id))
-            
-            count = cursor.fetchone()[0]
-            
-            if count > 0:
-                # Update the most recent location in this session to be an end point
-                cursor.execute('''
+    today = datetime.now(MOSCOW_TZ).strftime('%Y-%m-%d')
+    
+    with _write_lock:
+        conn = get_write_connection()
+        try:
+            with conn:
+                cursor = conn.execute('''
                     UPDATE location_history
                     SET location_type = 'end'
-                    WHERE id = (
-                        SELECT id FROM location_history
-                        WHERE user_id = ? AND session_id = ?
-                        ORDER BY timestamp DESC LIMIT 1
+                    WHERE id IN (
+                        SELECT id FROM (
+                            SELECT id, location_type,
+                                   ROW_NUMBER() OVER (PARTITION BY session_id ORDER BY timestamp DESC) AS rn
+                            FROM location_history
+                            WHERE user_id = ? AND session_id IN (
+                                SELECT session_id FROM location_history
+                                WHERE user_id = ? AND timestamp >= ? AND timestamp < ?
+                                    AND location_type != 'end'
+                            )
+                        )
+                        WHERE rn = 1 AND location_type != 'end'
                     )
-                ''', (user_id, session_id))
-                logger.info(f"Marked last point as end for session {session_id}")
-            else:
-                logger.warning(f"No locations found for session {session_id}, user {user_id}")
-        
-        conn.commit()
-    except Exception as e:
-        logger.error(f"Error marking session {session_id} as ended: {e}")
-    finally:
-        conn.close()
+                ''', (user_id, user_id, *_day_range(today)))
+            return cursor.rowcount
+        except Exception as e:
+            logger.error(f"Error marking sessions of user {user_id} as ended: {e}")
+            return 0
+
+def mark_session_ended(session_id, user_id, latitude=None, longitude=None):
+    """Mark a location session as ended
+    
+    If latitude and longitude are provided, adds a final location point
+    with location_type='end'. Otherwise, just marks the last point as 'end'.
+    
+    Returns:
+        False, если запись в БД не удалась
+    """
+    # Последняя точка сессии может быть еще в буфере
+    flush_location_buffer()
+    _forget_active_session(user_id)
+    
+    with _write_lock:
+        conn = get_write_connection()
+        try:
+            with conn:
+                if latitude and longitude:
+                    # Add a final location point
+                    conn.execute('''
+                        INSERT INTO location_history (user_id, latitude, longitude, session_id, location_type)
+                        VALUES (?, ?, ?, ?, 'end')
+                    ''', (user_id, latitude, longitude, session_id))
+                    logger.info(f"Added end location point for session {session_id}")
+                else:
+                    # Update the most recent location in this session to be an end point;
+                    # rowcount 0 means the session has no points
+                    cursor = conn.execute('''
+                        UPDATE location_history
+                        SET location_type = 'end'
+                        WHERE id = (
+                            SELECT id FROM location_history
+                            WHERE user_id = ? AND session_id = ?
+                            ORDER BY timestamp DESC LIMIT 1
+                        )
+                    ''', (user_id, session_id))
+                    if cursor.rowcount:
+                        logger.info(f"Marked last point as end for session {session_id}")
+                    else:
+                        logger.warning(f"No locations found for session {session_id}, user {user_id}")
+        except Exception:
+            # with conn уже откатил транзакцию на общем соединении
+            logger.exception(f"Error marking session {session_id} as ended")
+            return False
     return True
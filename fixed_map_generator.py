@@ -64,7 +64,11 @@ def get_status_history_from_db(user_id, date):
     return status_history
 
 def get_locations_from_db(user_id, date):
-    """Напрямую получаем координаты из базы данных"""
+    """Напрямую получаем координаты из базы данных
+    
+    timestamp в location_history хранится в секундах unix epoch; для совмещения
+    со статусами он отдается строкой 'YYYY-MM-DD HH:MM:SS', как в status_history.
+    """
     conn = sqlite3.connect(DATABASE_FILE)
     cursor = conn.cursor()
     
@@ -73,10 +77,10 @@ def get_locations_from_db(user_id, date):
         start_datetime = f"{date} 00:00:00"
         end_datetime = f"{date} 23:59:59"
         cursor.execute('''
-            SELECT latitude, longitude, timestamp, session_id, location_type
+            SELECT latitude, longitude, datetime(timestamp, 'unixepoch') AS timestamp, session_id, location_type
             FROM location_history
-            WHERE user_id = ? AND timestamp BETWEEN ? AND ?
-            ORDER BY timestamp ASC
+            WHERE user_id = ? AND timestamp BETWEEN CAST(strftime('%s', ?) AS INTEGER) AND CAST(strftime('%s', ?) AS INTEGER)
+            ORDER BY location_history.timestamp ASC
         ''', (user_id, start_datetime, end_datetime))
     else:
         # Если дата не указана, возвращаем за сегодня
@@ -84,10 +88,10 @@ def get_locations_from_db(user_id, date):
         start_datetime = f"{today} 00:00:00"
         end_datetime = f"{today} 23:59:59"
         cursor.execute('''
-            SELECT latitude, longitude, timestamp, session_id, location_type
+            SELECT latitude, longitude, datetime(timestamp, 'unixepoch') AS timestamp, session_id, location_type
             FROM location_history
-            WHERE user_id = ? AND timestamp BETWEEN ? AND ?
-            ORDER BY timestamp ASC
+            WHERE user_id = ? AND timestamp BETWEEN CAST(strftime('%s', ?) AS INTEGER) AND CAST(strftime('%s', ?) AS INTEGER)
+            ORDER BY location_history.timestamp ASC
         ''', (user_id, start_datetime, end_datetime))
     
     all_locations = cursor.fetchall()
@@ -116,7 +120,22 @@ def get_locations_from_db(user_id, date):
     logger.info(f"После обработки получено {len(valid_locations)} корректных записей")
     return valid_locations
 
-def create_direct_map(user_id, date=None):
+def save_map(m, map_filename, out=None):
+    """
+    Сохраняет карту в файл map_filename или, если передан out, в бинарный буфер
+    
+    Returns:
+        Имя файла карты
+    """
+    if out is None:
+        m.save(map_filename)
+    else:
+        # close_file=False: буфер нужен вызывающему коду для отправки
+        m.save(out, close_file=False)
+        out.seek(0)
+    return map_filename
+
+def create_direct_map(user_id, date=None, out=None):
     """
     Создает карту напрямую из базы данных, минуя стандартные функции
     Даже при отсутствии данных о местоположении, создает базовую карту с информацией о статусах
@@ -124,6 +143,8 @@ def create_direct_map(user_id, date=None):
     Args:
         user_id: ID пользователя
         date: Дата в формате 'YYYY-MM-DD', если None - сегодняшняя дата
+        out: Бинарный буфер (например, io.BytesIO); если передан, карта
+            пишется в него, а не на диск
         
     Returns:
         Имя файла карты или None если совсем нет данных
@@ -172,7 +193,7 @@ def create_direct_map(user_id, date=None):
         
         # Сохраняем карту
         map_filename = f"map_{safe_user_name}_{date or datetime.now().strftime('%Y-%m-%d')}.html"
-        m.save(map_filename)
+        save_map(m, map_filename, out)
         logger.info(f"Создана пустая карта: {map_filename}")
         return map_filename
     
@@ -221,7 +242,7 @@ def create_direct_map(user_id, date=None):
         
         # Сохраняем карту
         map_filename = f"map_{safe_user_name}_{date or datetime.now().strftime('%Y-%m-%d')}.html"
-        m.save(map_filename)
+        save_map(m, map_filename, out)
         logger.info(f"Создана карта со статусами без координат: {map_filename}")
         return map_filename
     
@@ -280,7 +301,7 @@ def create_direct_map(user_id, date=None):
         if isinstance(time_key, str):
             try:
                 # Пробуем преобразовать строку в объект datetime
-                return datetime.strptime(time_key[:19], '%Y-%m-%d %H:%M:%S')
+                return datetime.fromisoformat(time_key[:19])
             except:
                 # Если не удалось, используем строку
                 return time_key
@@ -307,7 +328,7 @@ def create_direct_map(user_id, date=None):
             
             # Обновляем текущий статус
             current_status = status
-            logger.debug(f"Изменение статуса на {status} в {time_key}")
+            logger.debug("Изменение статуса на %s в %s", status, time_key)
             
             # Добавляем маркер изменения статуса, если есть координаты
             if location_events:
@@ -343,7 +364,7 @@ def create_direct_map(user_id, date=None):
             time_str = time_key
             try:
                 if isinstance(time_key, str):
-                    time_obj = datetime.strptime(time_key, '%Y-%m-%d %H:%M:%S')
+                    time_obj = datetime.fromisoformat(time_key)
                     # Добавляем 3 часа к времени для соответствия московскому часовому поясу
                     adjusted_time = time_obj.replace(hour=(time_obj.hour + 3) % 24)
                     time_str = adjusted_time.strftime('%H:%M:%S')
@@ -502,7 +523,7 @@ def create_direct_map(user_id, date=None):
     
     # Сохраняем карту
     map_filename = f"map_{safe_user_name}_{date or datetime.now().strftime('%Y-%m-%d')}.html"
-    m.save(map_filename)
+    save_map(m, map_filename, out)
     logger.info(f"Карта успешно создана: {map_filename}")
     
     return map_filename
@@ -351,9 +351,7 @@ def webhook():
             return jsonify({"status": "success"})
             
         except Exception as e:
-            logger.error(f"Error processing webhook: {e}")
-            import traceback
-            logger.error(traceback.format_exc())
+            logger.exception(f"Error processing webhook: {e}")
             
             # В случае ошибки тоже пытаемся сохранить данные запроса
             try:
@@ -1,10 +1,33 @@
 import sqlite3
 import logging
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
 from config import DATABASE_FILE, MOSCOW_TZ
 
 logger = logging.getLogger(__name__)
 
+# Кэш имен пользователей: user_id -> (full_name, expires_at).
+# Имя запрашивается на каждое обновление геопозиции и статуса, а меняется редко;
+# TTL ограничивает устаревание, если таблицу правит другой процесс (веб-интерфейс)
+USER_NAME_CACHE_TTL = 300
+_user_name_cache = {}
+
+def invalidate_user_name_cache(user_id=None):
+    """Сбрасывает кэш имен для одного пользователя или целиком"""
+    if user_id is None:
+        _user_name_cache.clear()
+    else:
+        _user_name_cache.pop(user_id, None)
+
+# Кэш списка пользователей для меню администратора и плановых задач;
+# сбрасывается при изменениях через бота, TTL - для правок из веб-интерфейса
+ALL_USERS_CACHE_TTL = 30
+_all_users_cache = {"exp": 0.0, "users": None}
+
+def invalidate_all_users_cache():
+    """Сбрасывает кэш списка пользователей"""
+    _all_users_cache["users"] = None
+
 def add_or_update_user_mapping(user_id, full_name, is_admin=None):
     """Add or update user mapping in the database
     
@@ -61,6 +84,8 @@ def add_or_update_user_mapping(user_id, full_name, is_admin=None):
                 logger.info(f"Создан новый пользователь {user_id} с правами администратора: {is_admin}")
         
         conn.commit()
+        invalidate_user_name_cache(user_id)
+        invalidate_all_users_cache()
         logger.info(f"User mapping updated for user ID {user_id}, name: {full_name}, admin: {is_admin}")
         return True
     except Exception as e:
@@ -72,6 +97,10 @@ def add_or_update_user_mapping(user_id, full_name, is_admin=None):
 
 def get_user_name_by_id(user_id):
     """Get user's full name by user ID"""
+    cached = _user_name_cache.get(user_id)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    
     conn = sqlite3.connect(DATABASE_FILE)
     cursor = conn.cursor()
     
@@ -82,6 +111,11 @@ def get_user_name_by_id(user_id):
     result = cursor.fetchone()
     conn.close()
     
+    # Кэшируем только найденные имена, чтобы новый пользователь,
+    # добавленный через веб-интерфейс, сразу стал виден боту
+    if result:
+        _user_name_cache[user_id] = (result[0], time.monotonic() + USER_NAME_CACHE_TTL)
+    
     return result[0] if result else None
 
 def get_user_id_by_name(full_name):
@@ -100,6 +134,11 @@ def get_user_id_by_name(full_name):
 
 def get_all_users():
     """Get all users from the mapping table"""
+    users = _all_users_cache["users"]
+    if users is not None and _all_users_cache["exp"] > time.monotonic():
+        # Копия, чтобы вызывающий код не мог испортить кэш
+        return list(users)
+    
     conn = sqlite3.connect(DATABASE_FILE)
     cursor = conn.cursor()
     
@@ -110,6 +149,8 @@ def get_all_users():
     users = cursor.fetchall()
     conn.close()
     
+    _all_users_cache["users"] = tuple(users)
+    _all_users_cache["exp"] = time.monotonic() + ALL_USERS_CACHE_TTL
     return users
 
 def delete_user(user_id):
@@ -156,6 +197,8 @@ def delete_user(user_id):
         ''', (user_id,))
         
         conn.commit()
+        invalidate_user_name_cache(user_id)
+        invalidate_all_users_cache()
         rows_affected = cursor.rowcount
         logger.info(f"User ID {user_id} deleted. Rows affected: {rows_affected}")
         return rows_affected > 0
@@ -188,6 +231,7 @@ def set_user_admin_status(user_id, is_admin):
         ''', (1 if is_admin else 0, user_id))
         
         conn.commit()
+        invalidate_all_users_cache()
         logger.info(f"Admin status for user ID {user_id} set to {is_admin}")
         return cursor.rowcount > 0
     except Exception as e:
@@ -204,7 +248,7 @@ def record_morning_check(user_id, check_date, checked_in=False):
     
     try:
         cursor.execute('''
-            INSERT OR IGNORE INTO morning_checks (user_id, date, checked_in, notified, admin_notified)
+            INSERT OR IGNORE INTO morning_checks (user_id, check_date, checked_in, notified, admin_notified)
             VALUES (?, ?, ?, 0, 0)
         ''', (user_id, check_date, checked_in))
         
@@ -224,8 +268,8 @@ def update_morning_check(user_id, check_date, checked_in=True):
     try:
         # Проверяем, существует ли запись
         cursor.execute('''
-            SELECT id FROM morning_checks 
-            WHERE user_id = ? AND date = ?
+            SELECT 1 FROM morning_checks 
+            WHERE user_id = ? AND check_date = ?
         ''', (user_id, check_date))
         
         if cursor.fetchone():
@@ -233,12 +277,12 @@ def update_morning_check(user_id, check_date, checked_in=True):
             cursor.execute('''
                 UPDATE morning_checks 
                 SET checked_in = ? 
-                WHERE user_id = ? AND date = ?
+                WHERE user_id = ? AND check_date = ?
             ''', (checked_in, user_id, check_date))
         else:
             # Создаем новую запись
             cursor.execute('''
-                INSERT INTO morning_checks (user_id, date, checked_in)
+                INSERT INTO morning_checks (user_id, check_date, checked_in)
                 VALUES (?, ?, ?)
             ''', (user_id, check_date, checked_in))
         
@@ -250,6 +294,26 @@ def update_morning_check(user_id, check_date, checked_in=True):
     finally:
         conn.close()
 
+# Уже отмеченные за день пользователи: (user_id, date).
+# Статус и каждая точка живой геолокации отмечают утреннюю проверку,
+# поэтому без этого кэша за день набираются тысячи одинаковых UPDATE
+_morning_checked_in = set()
+
+def mark_morning_checked_in(user_id, check_date):
+    """Отметить утреннюю проверку пользователя, обращаясь к БД не чаще раза в день"""
+    key = (user_id, check_date)
+    if key in _morning_checked_in:
+        return True
+    
+    if update_morning_check(user_id, check_date, checked_in=True):
+        _morning_checked_in.add(key)
+        return True
+    return False
+
+def reset_morning_checked_in_cache():
+    """Сбросить кэш отметок утренней проверки (при смене дня)"""
+    _morning_checked_in.clear()
+
 def update_morning_check_notification(user_id, check_date, notified=False, admin_notified=False):
     """Update notification status for morning check"""
     conn = sqlite3.connect(DATABASE_FILE)
@@ -258,8 +322,8 @@ def update_morning_check_notification(user_id, check_date, notified=False, admin
     try:
         # Проверяем, существует ли запись
         cursor.execute('''
-            SELECT id FROM morning_checks 
-            WHERE user_id = ? AND date = ?
+            SELECT 1 FROM morning_checks 
+            WHERE user_id = ? AND check_date = ?
         ''', (user_id, check_date))
         
         if cursor.fetchone():
@@ -267,12 +331,12 @@ def update_morning_check_notification(user_id, check_date, notified=False, admin
             cursor.execute('''
                 UPDATE morning_checks 
                 SET notified = ?, admin_notified = ? 
-                WHERE user_id = ? AND date = ?
+                WHERE user_id = ? AND check_date = ?
             ''', (notified, admin_notified, user_id, check_date))
         else:
             # Создаем новую запись
             cursor.execute('''
-                INSERT INTO morning_checks (user_id, date, notified, admin_notified)
+                INSERT INTO morning_checks (user_id, check_date, notified, admin_notified)
                 VALUES (?, ?, ?, ?)
             ''', (user_id, check_date, notified, admin_notified))
         
@@ -298,7 +362,7 @@ def get_unchecked_users_for_morning(check_date):
         
         for (user_id,) in all_users:
             cursor.execute('''
-                INSERT OR IGNORE INTO morning_checks (user_id, date, checked_in)
+                INSERT OR IGNORE INTO morning_checks (user_id, check_date, checked_in)
                 VALUES (?, ?, 0)
             ''', (user_id, check_date))
         
@@ -309,7 +373,7 @@ def get_unchecked_users_for_morning(check_date):
             SELECT mc.user_id, um.full_name, mc.notified, mc.admin_notified
             FROM morning_checks mc
             JOIN user_mapping um ON mc.user_id = um.user_id
-            WHERE mc.date = ? AND mc.checked_in = 0
+            WHERE mc.check_date = ? AND mc.checked_in = 0
             ORDER BY um.full_name
         ''', (check_date,))
         
@@ -321,6 +385,36 @@ def get_unchecked_users_for_morning(check_date):
     finally:
         conn.close()
 
+def get_morning_check_stats(check_date):
+    """Итоги утренней проверки за день одним проходом по morning_checks
+    
+    Returns:
+        Словарь {'total', 'checked_in', 'notified', 'admin_notified'}
+    """
+    conn = sqlite3.connect(DATABASE_FILE)
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute('''
+            SELECT COUNT(*),
+                   COALESCE(SUM(checked_in), 0),
+                   COALESCE(SUM(notified), 0),
+                   COALESCE(SUM(admin_notified), 0)
+            FROM morning_checks
+            WHERE check_date = ?
+        ''', (check_date,))
+        
+        total, checked_in, notified, admin_notified = cursor.fetchone()
+        return {
+            'total': total, 'checked_in': checked_in,
+            'notified': notified, 'admin_notified': admin_notified
+        }
+    except Exception as e:
+        logger.error(f"Error getting morning check stats: {e}")
+        return {'total': 0, 'checked_in': 0, 'notified': 0, 'admin_notified': 0}
+    finally:
+        conn.close()
+
 def is_user_in_night_shift(user_id):
     """Check if a user is currently in night shift"""
     conn = sqlite3.connect(DATABASE_FILE)
@@ -385,10 +479,7 @@ def create_timeoff_request(user_id, username, reason):
         logger.info(f"Запрос на отгул успешно создан: ID={request_id}")
         return request_id
     except Exception as e:
-        logger.error(f"Ошибка при создании запроса на отгул: {e}")
-        # Добавляем полный трейс для отладки
-        import traceback
-        logger.error(f"Трейс ошибки: {traceback.format_exc()}")
+        logger.exception(f"Ошибка при создании запроса на отгул: {e}")
         return None
     finally:
         conn.close()
@@ -518,14 +609,48 @@ def get_timeoff_stats_for_user(user_id, date=None, days=30):
         
         return stats
     except Exception as e:
-        logger.error(f"Error getting time-off stats for user {user_id}: {e}")
-        # Печатаем полный trace для отладки
-        import traceback
-        logger.error(f"Traceback: {traceback.format_exc()}")
+        logger.exception(f"Error getting time-off stats for user {user_id}: {e}")
         return {'total': 0, 'approved': 0, 'rejected': 0, 'pending': 0}
     finally:
         conn.close()
 
+def get_timeoff_stats_bulk(days=30):
+    """Статистика запросов на отгул сразу по всем пользователям одним запросом
+    
+    Args:
+        days: Количество дней назад для фильтрации
+    
+    Returns:
+        Словарь {user_id: {'total', 'approved', 'rejected', 'pending'}};
+        пользователи без запросов за период в словарь не попадают
+    """
+    past_date_str = (datetime.now(MOSCOW_TZ) - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+    
+    conn = sqlite3.connect(DATABASE_FILE)
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute('''
+            SELECT user_id,
+                   COUNT(*),
+                   SUM(status = 'approved'),
+                   SUM(status = 'rejected'),
+                   SUM(status = 'pending')
+            FROM timeoff_requests
+            WHERE request_time >= ?
+            GROUP BY user_id
+        ''', (past_date_str,))
+        
+        return {
+            user_id: {'total': total, 'approved': approved, 'rejected': rejected, 'pending': pending}
+            for user_id, total, approved, rejected, pending in cursor.fetchall()
+        }
+    except Exception as e:
+        logger.exception(f"Error getting bulk time-off stats: {e}")
+        return {}
+    finally:
+        conn.close()
+
 def update_timeoff_request(request_id, status, admin_id):
     """Update the status of a time-off request"""
     conn = sqlite3.connect(DATABASE_FILE)
@@ -561,10 +686,7 @@ def update_timeoff_request(request_id, status, admin_id):
         logger.info(f"Статус запроса ID={request_id} успешно обновлен на '{status}'")
         return user_id, username
     except Exception as e:
-        logger.error(f"Ошибка при обновлении запроса на отгул: {e}")
-        # Добавляем трейс ошибки для отладки
-        import traceback
-        logger.error(f"Трейс ошибки: {traceback.format_exc()}")
+        logger.exception(f"Ошибка при обновлении запроса на отгул: {e}")
         return None, None
     finally:
         conn.close()
@@ -1,18 +1,29 @@
 import logging
 import os
 from datetime import datetime, time, timedelta
+import pytz
+from telegram.error import RetryAfter
 from telegram.ext import CallbackContext
 from models import (
     get_unchecked_users_for_morning, record_morning_check, 
     update_morning_check_notification, is_user_in_night_shift,
-    get_all_users
+    get_all_users, reset_morning_checked_in_cache, get_morning_check_stats
 )
 from config import MOSCOW_TZ, ADMIN_ID, MORNING_CHECK_START_TIME, MORNING_CHECK_END_TIME, DAILY_REPORT_TIME
-from utils import is_workday, generate_csv_report, create_map_for_user
-from database import get_user_locations, get_active_location_sessions, mark_session_ended
+from utils import (
+    is_workday, generate_csv_report, create_map_for_user, LocationState,
+    take_admin_notifications, return_admin_notifications, throttle_outgoing, parse_timestamp
+)
+from database import (
+    get_user_locations, get_active_location_sessions, mark_all_sessions_ended,
+    save_locations_bulk, current_utc_timestamp,
+)
 
 logger = logging.getLogger(__name__)
 
+# Интервал утренней проверки внутри окна MORNING_CHECK_START_TIME - MORNING_CHECK_END_TIME
+MORNING_CHECK_INTERVAL = 600  # секунды
+
 def morning_check_task(context: CallbackContext):
     """Task to check if users have reported their status by 8:30 AM"""
     now = datetime.now(MOSCOW_TZ)
@@ -110,15 +121,12 @@ def morning_check_task(context: CallbackContext):
                     f"Вы еще не отметили свой статус сегодня. "
                     f"Пожалуйста, нажмите одну из кнопок статуса на клавиатуре."
                 )
-                # Get user keyboard from bot.py
-                from bot import get_user_keyboard
-                from telegram import ReplyKeyboardMarkup
-                
-                # Create keyboard with status buttons
-                user_keyboard = get_user_keyboard(user_id)
-                reply_markup = ReplyKeyboardMarkup(user_keyboard, resize_keyboard=True)
+                # Get prebuilt user keyboard from bot.py
+                from bot import get_user_reply_markup
+                reply_markup = get_user_reply_markup(user_id)
                 
                 # Send message with keyboard
+                throttle_outgoing(user_id)
                 context.bot.send_message(
                     chat_id=user_id, 
                     text=user_message,
@@ -135,6 +143,7 @@ def morning_check_task(context: CallbackContext):
                     f"⚠️ Уведомление о непройденной утренней отметке:\n\n"
                     f"Пользователь {full_name} не отметил свой статус сегодня до 8:30."
                 )
+                throttle_outgoing(ADMIN_ID)
                 context.bot.send_message(chat_id=ADMIN_ID, text=admin_message)
                 logger.info(f"Admin notification sent for user {full_name} (ID: {user_id})")
             except Exception as e:
@@ -143,6 +152,42 @@ def morning_check_task(context: CallbackContext):
         # Update the notification status
         update_morning_check_notification(user_id, today_date, notified=True, admin_notified=True)
 
+def _morning_window(day):
+    """Границы окна утренней проверки (начало, конец) по Москве для даты day
+    
+    Границы передаются в JobQueue, а APScheduler 3.6 (зависимость PTB 13.7)
+    принимает только часовые пояса pytz, поэтому они возвращаются в pytz.utc.
+    """
+    start = datetime.combine(day, time(*MORNING_CHECK_START_TIME), tzinfo=MOSCOW_TZ)
+    end = datetime.combine(day, time(*MORNING_CHECK_END_TIME), tzinfo=MOSCOW_TZ)
+    return start.astimezone(pytz.utc), end.astimezone(pytz.utc)
+
+def schedule_morning_checks(job_queue):
+    """Запланировать morning_check_task только на ближайшее утреннее окно
+    
+    Вместо опроса каждые 10 минут круглые сутки проверка запускается
+    с интервалом MORNING_CHECK_INTERVAL лишь внутри окна. По окончании окна
+    задача сама планирует следующее.
+    """
+    now = datetime.now(MOSCOW_TZ)
+    start, end = _morning_window(now.date())
+    if now >= end:
+        start, end = _morning_window(now.date() + timedelta(days=1))
+    
+    job_queue.run_repeating(
+        morning_check_task,
+        interval=MORNING_CHECK_INTERVAL,
+        # Внутри уже начавшегося окна первая проверка - сразу
+        first=start if now < start else 0,
+        last=end
+    )
+    job_queue.run_once(_reschedule_morning_checks_task, when=end)
+    logger.info(f"Scheduled morning checks from {start} to {end}")
+
+def _reschedule_morning_checks_task(context: CallbackContext):
+    """Task to plan the next morning check window"""
+    schedule_morning_checks(context.job_queue)
+
 def reset_morning_checks_task(context: CallbackContext):
     """Task to reset morning checks for the new day"""
     now = datetime.now(MOSCOW_TZ)
@@ -160,8 +205,55 @@ def reset_morning_checks_task(context: CallbackContext):
     today_date = now.strftime('%Y-%m-%d')
     logger.info(f"Resetting morning checks for {today_date}")
     
+    # Итоги вчерашней проверки одним запросом
+    yesterday = (now - timedelta(days=1)).strftime('%Y-%m-%d')
+    stats = get_morning_check_stats(yesterday)
+    if stats['total']:
+        logger.info(
+            f"Morning checks for {yesterday}: {stats['checked_in']}/{stats['total']} checked in, "
+            f"{stats['notified']} users and {stats['admin_notified']} admin notifications"
+        )
+    
+    # Вчерашние отметки больше не нужны - освобождаем кэш
+    reset_morning_checked_in_cache()
+    
     # Reset will happen automatically in get_unchecked_users_for_morning() when called
 
+# Максимальная длина сообщения Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+def admin_notification_task(context: CallbackContext):
+    """Задача для отправки накопленных уведомлений администратору
+    
+    Соседние уведомления склеиваются в одно сообщение (в пределах лимита длины).
+    При RetryAfter неотправленное возвращается в очередь до следующего запуска.
+    """
+    batch = take_admin_notifications()
+    if not batch:
+        return
+    
+    # Склеиваем уведомления в сообщения не длиннее лимита Telegram
+    messages = []
+    for text in batch:
+        if messages and len(messages[-1][0]) + len(text) + 2 <= TELEGRAM_MESSAGE_LIMIT:
+            messages[-1][0] += "\n\n" + text
+            messages[-1][1].append(text)
+        else:
+            messages.append([text, [text]])
+    
+    for index, (message, parts) in enumerate(messages):
+        try:
+            throttle_outgoing(ADMIN_ID)
+            context.bot.send_message(chat_id=ADMIN_ID, text=message, parse_mode='HTML')
+        except RetryAfter as e:
+            # Превышен лимит отправки - повторим позже, сохранив порядок
+            pending = [text for _, texts in messages[index:] for text in texts]
+            return_admin_notifications(pending)
+            logger.warning(f"Лимит Telegram, отправка {len(pending)} уведомлений отложена на {e.retry_after} с")
+            return
+        except Exception as e:
+            logger.error(f"Ошибка при отправке уведомления администратору: {e}")
+
 def location_interval_task(context: CallbackContext):
     """Задача для сохранения местоположения пользователей каждые 5 минут
     
@@ -172,23 +264,23 @@ def location_interval_task(context: CallbackContext):
     
     # Получаем всех пользователей, которые активно делятся местоположением
     active_users = []
+    # Состояния трансляции пользователей: user_id -> LocationState
+    location_states = {}
     chat_data = context.dispatcher.chat_data
     
     # Итерация по всем чатам
     for chat_id, data in chat_data.items():
         # Проверяем, что data - это словарь (dict)
         if isinstance(data, dict):
-            # Проверяем, есть ли ключи отслеживания местоположения
+            # Ищем состояния трансляции геопозиции (handle_location хранит их по user_id)
             for key, value in data.items():
-                if isinstance(key, str) and key.startswith("location_tracking_") and value:
-                    user_id = int(key.replace("location_tracking_", ""))
-                    session_id = data.get(f"location_session_{user_id}")
-                    if session_id:
-                        active_users.append((user_id, session_id))
+                if isinstance(value, LocationState):
+                    location_states[key] = value
+                    if value.tracking and value.session_id:
+                        active_users.append((key, value.session_id))
     
     # Также добавляем все активные сессии из базы данных для дополнительной надежности
     try:
-        from database import get_active_location_sessions
         from models import get_all_users
         
         users = get_all_users()
@@ -210,6 +302,8 @@ def location_interval_task(context: CallbackContext):
     # Для каждого активного пользователя пробуем получить актуальное местоположение от Telegram
     # Мы не можем получить местоположение напрямую, поэтому используем Live Location API
     # Но мы можем запросить у пользователя его текущее местоположение
+    # Свежие точки копятся и записываются одной транзакцией после обхода
+    pending_rows = []
     for user_id, session_id in active_users:
         try:
             # Получаем имя пользователя
@@ -218,24 +312,22 @@ def location_interval_task(context: CallbackContext):
             
             # Пробуем найти пользователя в chat_data и проверяем наличие обновленного местоположения
             # В функции handle_location мы записываем последнее местоположение в chat_data
-            user_location_data = context.dispatcher.chat_data.get(user_id, {}).get('last_location', None)
+            state = location_states.get(user_id)
             
-            if user_location_data:
-                lat = user_location_data.get('latitude')
-                lon = user_location_data.get('longitude')
+            if state and state.fresh_location:
+                lat = state.last_lat
+                lon = state.last_lon
                 
                 # Проверяем данные на валидность
                 if lat is not None and lon is not None:
-                    from database import save_location
-                    
-                    # Сохраняем новую промежуточную точку с актуальными координатами
-                    save_location(user_id, lat, lon, session_id=session_id, location_type='intermediate')
-                    logger.info(f"Сохранено актуальное местоположение [{lat}, {lon}] для пользователя {user_name}")
+                    # Новая промежуточная точка с актуальными координатами
+                    pending_rows.append((user_id, lat, lon, current_utc_timestamp(), session_id, 'intermediate'))
+                    logger.info(f"Актуальное местоположение [{lat}, {lon}] для пользователя {user_name} поставлено в запись")
                     
-                    # Сбрасываем местоположение в chat_data, чтобы при следующем обновлении не использовать старые данные
-                    context.dispatcher.chat_data[user_id]['last_location'] = None
+                    # Помечаем точку учтенной, чтобы при следующем запуске не использовать старые данные
+                    state.fresh_location = False
                 else:
-                    logger.warning(f"Некорректные координаты для пользователя {user_name}: {user_location_data}")
+                    logger.warning(f"Некорректные координаты для пользователя {user_name}: [{lat}, {lon}]")
             else:
                 # Если нет данных о местоположении в chat_data, запрашиваем его у пользователя
                 try:
@@ -250,20 +342,8 @@ def location_interval_task(context: CallbackContext):
                     if not last_locations:
                         should_request = True
                     else:
-                        # Проверяем формат timestamp и безопасно конвертируем его
-                        last_timestamp = last_locations[-1][2]
-                        if isinstance(last_timestamp, str):
-                            try:
-                                last_timestamp_dt = datetime.strptime(last_timestamp, '%Y-%m-%d %H:%M:%S')
-                            except ValueError:
-                                try:
-                                    last_timestamp_dt = datetime.strptime(last_timestamp, '%Y-%m-%d %H:%M:%S.%f')
-                                except Exception:
-                                    # Если не удалось распарсить, считаем что обновление нужно
-                                    should_request = True
-                                    last_timestamp_dt = None
-                        else:
-                            last_timestamp_dt = last_timestamp
+                        # Безопасно конвертируем timestamp; None (не удалось распарсить) - обновление нужно
+                        last_timestamp_dt = parse_timestamp(last_locations[-1].timestamp)
                         
                         # Проверяем разницу во времени, если timestamp успешно преобразован
                         if last_timestamp_dt is not None:
@@ -283,6 +363,7 @@ def location_interval_task(context: CallbackContext):
                     
                     if should_request:
                         # Отправляем пользователю сообщение с просьбой поделиться местоположением
+                        throttle_outgoing(user_id)
                         context.bot.send_message(
                             chat_id=user_id,
                             text="Пожалуйста, поделитесь вашим текущим местоположением для обновления маршрута."
@@ -292,6 +373,13 @@ def location_interval_task(context: CallbackContext):
                     logger.error(f"Ошибка при запросе местоположения у пользователя {user_name}: {loc_err}")
         except Exception as e:
             logger.error(f"Ошибка при обновлении местоположения для пользователя {user_id}: {e}")
+    
+    if pending_rows:
+        try:
+            saved = save_locations_bulk(pending_rows)
+            logger.info(f"Сохранено {saved} актуальных точек местоположения")
+        except Exception as e:
+            logger.error(f"Ошибка при пакетном сохранении местоположений: {e}")
 
 def daily_report_task(context: CallbackContext, force=False):
     """Task to generate and send daily reports at 17:30
@@ -329,13 +417,16 @@ def daily_report_task(context: CallbackContext, force=False):
     users = [(user[0], user[1]) for user in users_data]
     logger.info(f"Обработка {len(users)} пользователей")
     
+    # Отчеты и карты приходят без звука, администратор получает
+    # одно уведомление-итог вместо двух на каждого пользователя
+    reports_sent = 0
+    
     for user_id, user_name in users:
         try:
             # End any active location sessions
-            active_sessions = get_active_location_sessions(user_id)
-            for session_id in active_sessions:
-                mark_session_ended(session_id, user_id)
-                logger.info(f"Ended active location session {session_id} for user {user_name} (ID: {user_id})")
+            closed = mark_all_sessions_ended(user_id)
+            if closed:
+                logger.info(f"Ended {closed} active location sessions for user {user_name} (ID: {user_id})")
             
             # Generate report
             report_file = generate_csv_report(user_id, today_date)
@@ -345,12 +436,15 @@ def daily_report_task(context: CallbackContext, force=False):
                 report_message = f"📊 Ежедневный отчет для {user_name} ({today_date})"
                 
                 # Отправка отчета только администраторам
+                throttle_outgoing(ADMIN_ID)
                 context.bot.send_document(
                     chat_id=ADMIN_ID,
                     document=open(report_file, 'rb'),
                     filename=f"report_{user_name}_{today_date}.csv",
-                    caption=f"{report_message} (отправлен автоматически)"
+                    caption=f"{report_message} (отправлен автоматически)",
+                    disable_notification=True
                 )
+                reports_sent += 1
                 
                 # Generate map if locations available
                 locations = get_user_locations(user_id, hours_limit=24, date=today_date)
@@ -363,29 +457,16 @@ def daily_report_task(context: CallbackContext, force=False):
                         
                         for loc in locations:
                             try:
-                                # В get_today_locations_for_user возвращаются следующие данные:
-                                # (latitude, longitude, timestamp, session_id, location_type)
-                                lat, lon, timestamp, session_id, loc_type = loc
-                                
-                                # Проверяем и конвертируем данные
-                                if isinstance(lat, str):
-                                    lat = float(lat)
-                                if isinstance(lon, str):
-                                    lon = float(lon)
-                                
-                                # Форматируем timestamp, если он строка
-                                if isinstance(timestamp, str):
-                                    try:
-                                        timestamp = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S')
-                                    except ValueError:
-                                        try:
-                                            timestamp = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S.%f')
-                                        except Exception as e:
-                                            logger.error(f"Не удалось распарсить timestamp локации: {e}")
-                                            timestamp = datetime.now(MOSCOW_TZ)
+                                # get_user_locations возвращает LocationRow
+                                # (id, latitude, longitude, timestamp, location_type)
+                                # с уже разобранным timestamp
+                                lat, lon, timestamp, loc_type = (
+                                    loc.latitude, loc.longitude, loc.timestamp, loc.location_type
+                                )
                                 
                                 map_locations.append((lat, lon, timestamp, loc_type))
-                                logger.debug(f"Точка добавлена: {lat}, {lon}, {timestamp}, {loc_type}")
+                                if logger.isEnabledFor(logging.DEBUG):
+                                    logger.debug("Точка добавлена: %s, %s, %s, %s", lat, lon, timestamp, loc_type)
                             except Exception as e:
                                 logger.error(f"Ошибка при обработке локации для карты: {e}, данные: {loc}")
                                 continue
@@ -397,11 +478,13 @@ def daily_report_task(context: CallbackContext, force=False):
                             if map_file and os.path.exists(map_file):
                                 # Отправка карты только администраторам
                                 with open(map_file, 'rb') as f:
+                                    throttle_outgoing(ADMIN_ID)
                                     context.bot.send_document(
                                         chat_id=ADMIN_ID,
                                         document=f,
                                         filename=f"map_{user_name}_{today_date}.html",
-                                        caption=f"🗺️ Карта перемещений {user_name} за {today_date}"
+                                        caption=f"🗺️ Карта перемещений {user_name} за {today_date}",
+                                        disable_notification=True
                                     )
                                 
                                 # Clean up
@@ -421,6 +504,16 @@ def daily_report_task(context: CallbackContext, force=False):
                 logger.warning(f"No report file generated for user {user_name} (ID: {user_id})")
         except Exception as e:
             logger.error(f"Error generating daily report for user {user_id}: {e}")
+    
+    if reports_sent:
+        try:
+            throttle_outgoing(ADMIN_ID)
+            context.bot.send_message(
+                chat_id=ADMIN_ID,
+                text=f"📊 Ежедневные отчеты за {today_date} отправлены: {reports_sent}"
+            )
+        except Exception as e:
+            logger.error(f"Error sending daily report summary: {e}")
 
 
 def check_user_activity(context: CallbackContext):
@@ -459,17 +552,10 @@ def check_user_activity(context: CallbackContext):
                 last_status, status_timestamp = status_history[-1]
                 
                 # Безопасно конвертируем timestamp в datetime
-                if isinstance(status_timestamp, str):
-                    try:
-                        status_timestamp_dt = datetime.strptime(status_timestamp, '%Y-%m-%d %H:%M:%S')
-                    except ValueError:
-                        try:
-                            status_timestamp_dt = datetime.strptime(status_timestamp, '%Y-%m-%d %H:%M:%S.%f')
-                        except Exception as e:
-                            logger.error(f"Не удалось распарсить timestamp статуса для {user_name}: {e}")
-                            status_timestamp_dt = current_time
-                else:
-                    status_timestamp_dt = status_timestamp
+                status_timestamp_dt = parse_timestamp(status_timestamp)
+                if status_timestamp_dt is None:
+                    logger.error(f"Не удалось распарсить timestamp статуса для {user_name}: {status_timestamp}")
+                    status_timestamp_dt = current_time
                 
                 # Проверяем, не является ли текущий статус "безопасным" (отпуск, больничный, ночная смена)
                 safe_statuses = ['vacation', 'sick', 'to_night', 'from_night']
@@ -492,20 +578,13 @@ def check_user_activity(context: CallbackContext):
                     continue
                 
                 # Получаем время последнего обновления координат
-                last_timestamp = last_locations[-1][2]
+                last_timestamp = last_locations[-1].timestamp
                 
                 # Безопасно конвертируем timestamp в datetime
-                if isinstance(last_timestamp, str):
-                    try:
-                        last_timestamp_dt = datetime.strptime(last_timestamp, '%Y-%m-%d %H:%M:%S')
-                    except ValueError:
-                        try:
-                            last_timestamp_dt = datetime.strptime(last_timestamp, '%Y-%m-%d %H:%M:%S.%f')
-                        except Exception as e:
-                            logger.error(f"Не удалось распарсить timestamp локации для {user_name}: {e}")
-                            last_timestamp_dt = current_time
-                else:
-                    last_timestamp_dt = last_timestamp
+                last_timestamp_dt = parse_timestamp(last_timestamp)
+                if last_timestamp_dt is None:
+                    logger.error(f"Не удалось распарсить timestamp локации для {user_name}: {last_timestamp}")
+                    last_timestamp_dt = current_time
                 
                 # Проверяем, прошло ли 30 минут с момента последнего обновления координат
                 location_time_diff = (current_time - last_timestamp_dt).total_seconds()
@@ -536,6 +615,7 @@ def check_user_activity(context: CallbackContext):
                         )
                         
                         try:
+                            throttle_outgoing(ADMIN_ID)
                             context.bot.send_message(
                                 chat_id=ADMIN_ID,
                                 text=admin_message,
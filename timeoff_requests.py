@@ -280,7 +280,7 @@ def register_timeoff_handlers(dispatcher):
     # Register separate conversation handler for messages
     # This specifically handles the "📝 Отпроситься" button
     timeoff_msg_handler = ConversationHandler(
-        entry_points=[MessageHandler(Filters.regex('^📝 Отпроситься$'), start_timeoff_request)],
+        entry_points=[MessageHandler(Filters.text(['📝 Отпроситься']), start_timeoff_request)],
         states={
             TYPING_REASON: [MessageHandler(Filters.text & ~Filters.command, process_timeoff_reason)],
         },
@@ -291,4 +291,4 @@ def register_timeoff_handlers(dispatcher):
     dispatcher.add_handler(timeoff_msg_handler)  # Add the new handler
     dispatcher.add_handler(CommandHandler('myrequests', show_my_timeoff_requests))
     dispatcher.add_handler(CommandHandler('requests', show_pending_timeoff_requests))
-    dispatcher.add_handler(CallbackQueryHandler(handle_timeoff_response, pattern='^(approve|reject)_timeoff_'))
+    dispatcher.add_handler(CallbackQueryHandler(handle_timeoff_response, pattern='^(approve|reject)_timeoff_', run_async=True))
@@ -1,14 +1,13 @@
 import logging
 import os
 import sqlite3
-from datetime import datetime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove
 from telegram.ext import CallbackContext, ConversationHandler
 from models import (
     add_or_update_user_mapping, get_user_name_by_id, get_user_id_by_name, 
     get_all_users, delete_user, set_user_admin_status
 )
-from database import get_user_locations, DATABASE_FILE
+from database import get_latest_user_location, DATABASE_FILE
 from config import ADMIN_ID, ADMIN_IDS, MOSCOW_TZ
 
 # Состояния для диалога добавления пользователя
@@ -17,7 +16,11 @@ ADD_USER_ID, ADD_USER_NAME, ADD_USER_ADMIN_STATUS = range(3)
 logger = logging.getLogger(__name__)
 
 def is_admin(user_id):
-    """Check if a user is an admin"""
+    """Check if a user is an admin
+
+    Сравнение с ADMIN_ID из конфига - без обращения к БД, поэтому
+    проверка в начале каждого callback ничего не стоит.
+    """
     return user_id == ADMIN_ID
 
 def load_user_mappings_from_file(filename=None, update_db=False):
@@ -72,41 +75,17 @@ def get_formatted_user_info(user_id):
 
 def find_user_location(user_id, context: CallbackContext):
     """Find the most recent location of a user and format it for display"""
-    locations = get_user_locations(user_id, hours_limit=24)
-    
-    if not locations:
-        return "Данные о местоположении пользователя за последние 24 часа не найдены."
-    
     # Get the most recent location
-    most_recent = locations[-1]
-    
-    # Обрабатываем разные форматы данных из get_user_locations
-    if len(most_recent) >= 5:  # Полный формат с 5 полями (id, lat, lon, timestamp, loc_type)
-        location_id, lat, lon, timestamp, loc_type = most_recent
-    elif len(most_recent) >= 4:  # Формат с 4 полями
-        location_id, lat, lon, timestamp = most_recent
-        loc_type = 'промежуточная'
-    elif len(most_recent) >= 3:  # Минимальный формат
-        lat, lon, timestamp = most_recent[:3]
-        loc_type = 'промежуточная'
-    else:
-        return "Некорректный формат данных о местоположении."
+    most_recent = get_latest_user_location(user_id, hours_limit=24)
     
-    # Преобразуем в числовой формат, если нужно
-    if isinstance(lat, str):
-        lat = float(lat)
-    if isinstance(lon, str):
-        lon = float(lon)
+    if not most_recent:
+        return "Данные о местоположении пользователя за последние 24 часа не найдены."
     
-    # Форматируем timestamp, если он строка
-    if isinstance(timestamp, str):
-        try:
-            timestamp = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S')
-        except ValueError:
-            try:
-                timestamp = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S.%f')
-            except Exception as e:
-                return f"Ошибка преобразования времени: {e}"
+    # get_latest_user_location возвращает LocationRow с уже разобранным timestamp
+    lat, lon, timestamp, loc_type = (
+        most_recent.latitude, most_recent.longitude,
+        most_recent.timestamp, most_recent.location_type
+    )
     
     # Преобразуем в московское время, если не оно
     if hasattr(timestamp, 'astimezone'):
@@ -742,9 +721,11 @@ def register_admin_handlers(dispatcher):
     from telegram.ext import CommandHandler, CallbackQueryHandler, MessageHandler, Filters
     
     # Базовые обработчики команд
+    # Поиск местоположения строит карту и отправляет файл - выполняем в пуле потоков
+    # диспетчера, чтобы он не задерживал обработку остальных обновлений
     dispatcher.add_handler(CommandHandler("admin", handle_admin_command))
-    dispatcher.add_handler(CommandHandler("locate", handle_locate_command))
-    dispatcher.add_handler(CallbackQueryHandler(handle_locate_callback, pattern="^locate_user_"))
+    dispatcher.add_handler(CommandHandler("locate", handle_locate_command, run_async=True))
+    dispatcher.add_handler(CallbackQueryHandler(handle_locate_callback, pattern="^locate_user_", run_async=True))
     
     # Обработчики для управления пользователями
     dispatcher.add_handler(CallbackQueryHandler(handle_users_management, pattern="^admin_users$"))
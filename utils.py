@@ -1,14 +1,217 @@
-import logging
-import pandas as pd
-import folium
+import csv
 import io
-from datetime import datetime, time as dt_time
+import logging
+from datetime import datetime, timedelta, time as dt_time
 import os
+import threading
+from collections import deque
+from dataclasses import dataclass
+from functools import lru_cache
+from html import escape
+from math import sin, cos, sqrt, atan2, radians, hypot
+from time import monotonic, sleep
+from typing import Optional
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
 from config import MOSCOW_TZ, STATUS_OPTIONS
 
 logger = logging.getLogger(__name__)
 
+@dataclass(slots=True)
+class LocationState:
+    """Состояние трансляции геопозиции пользователя, хранится в chat_data[user_id]"""
+    last_lat: Optional[float] = None
+    last_lon: Optional[float] = None
+    last_ts: float = 0.0  # time.monotonic() последней точки
+    # Есть ли точка, еще не учтенная интервальной задачей location_interval_task
+    fresh_location: bool = False
+    stationary_duration: float = 0.0
+    movement_status: str = 'unknown'
+    speed: float = 0.0
+    admin_notified: bool = False
+    tracking: bool = False
+    session_id: Optional[str] = None
+
+def get_location_state(chat_data, user_id):
+    """Получить (или создать) состояние трансляции геопозиции пользователя"""
+    state = chat_data.get(user_id)
+    if not isinstance(state, LocationState):
+        state = chat_data[user_id] = LocationState()
+    return state
+
+# Очередь уведомлений администратору (готовый HTML). Обработчики только кладут
+# текст, отправляет одна задача по расписанию, склеивая соседние сообщения,
+# чтобы не упираться в лимиты Telegram и не задерживать ответы пользователям
+_admin_notifications = deque()
+
+def queue_admin_notification(text, html=False):
+    """Поставить уведомление администратору в очередь отправки
+    
+    Args:
+        text: Текст уведомления
+        html: True, если текст уже размечен HTML; иначе он экранируется
+    """
+    _admin_notifications.append(text if html else escape(text))
+
+def take_admin_notifications(limit=20):
+    """Забрать из очереди до limit уведомлений (в порядке поступления)"""
+    batch = []
+    while _admin_notifications and len(batch) < limit:
+        batch.append(_admin_notifications.popleft())
+    return batch
+
+def return_admin_notifications(batch):
+    """Вернуть неотправленные уведомления в начало очереди"""
+    _admin_notifications.extendleft(reversed(batch))
+
+# Лимиты Telegram на исходящие сообщения: около 30 в секунду на бота
+# и около одного в секунду в один чат (кратковременные всплески допускаются)
+TELEGRAM_GLOBAL_RATE = 30
+TELEGRAM_CHAT_RATE = 1
+TELEGRAM_CHAT_BURST = 5
+
+class TokenBucket:
+    """Потокобезопасный маркерный бакет: rate маркеров в секунду, не больше capacity"""
+    __slots__ = ("rate", "capacity", "tokens", "updated", "lock")
+    
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        """Забрать маркер, при необходимости подождав его появления"""
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+_global_send_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE)
+_chat_send_buckets = {}
+_chat_send_buckets_lock = threading.Lock()
+
+def throttle_outgoing(chat_id):
+    """Дождаться разрешения на отправку в чат chat_id в пределах лимитов Telegram
+    
+    Вызывается перед send_message/send_document в циклах рассылки,
+    чтобы всплеск сглаживался, а не заканчивался RetryAfter.
+    """
+    _global_send_bucket.acquire()
+    with _chat_send_buckets_lock:
+        bucket = _chat_send_buckets.get(chat_id)
+        if bucket is None:
+            bucket = _chat_send_buckets[chat_id] = TokenBucket(TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST)
+    bucket.acquire()
+
+# Кэш текущей даты по Москве: (today, tomorrow, expires_at по time.monotonic)
+_today_cache = {"exp": 0.0, "today": "", "tomorrow": ""}
+
+def _refresh_today_cache():
+    """Пересчитывает кэш дат; срок жизни - минута, но не дольше полуночи"""
+    now = datetime.now(MOSCOW_TZ)
+    tomorrow = now + timedelta(days=1)
+    seconds_to_midnight = (
+        (23 - now.hour) * 3600 + (59 - now.minute) * 60 + (60 - now.second)
+    )
+    _today_cache["today"] = now.strftime('%Y-%m-%d')
+    _today_cache["tomorrow"] = tomorrow.strftime('%Y-%m-%d')
+    _today_cache["exp"] = monotonic() + min(60, seconds_to_midnight)
+
+def today_str():
+    """Сегодняшняя дата по Москве в формате 'YYYY-MM-DD'"""
+    if monotonic() >= _today_cache["exp"]:
+        _refresh_today_cache()
+    return _today_cache["today"]
+
+def tomorrow_str():
+    """Завтрашняя дата по Москве в формате 'YYYY-MM-DD'"""
+    if monotonic() >= _today_cache["exp"]:
+        _refresh_today_cache()
+    return _today_cache["tomorrow"]
+
+def today_and_tomorrow_str():
+    """Пара (сегодня, завтра) по Москве из одного снимка кэша
+    
+    Отдельные вызовы today_str() и tomorrow_str() около полуночи могут попасть
+    по разные стороны обновления кэша и вернуть несогласованную пару.
+    """
+    if monotonic() >= _today_cache["exp"]:
+        _refresh_today_cache()
+    return _today_cache["today"], _today_cache["tomorrow"]
+
+@lru_cache(maxsize=1024)
+def is_valid_date_str(value):
+    """Проверить, что строка - дата в формате 'YYYY-MM-DD'
+    
+    Результат кэшируется, в том числе для некорректных строк.
+    fromisoformat разбирает дату без интерпретации строки формата, но
+    принимает и другие формы ISO 8601 (20250501, 2025-W18-4),
+    поэтому длина и разделители проверяются отдельно.
+    """
+    if len(value) != 10 or value[4] != '-' or value[7] != '-':
+        return False
+    try:
+        datetime.fromisoformat(value)
+        return True
+    except ValueError:
+        return False
+
+def parse_timestamp(value):
+    """Разобрать timestamp из БД: 'YYYY-MM-DD HH:MM:SS' с дробными секундами или без
+    
+    С Python 3.11 fromisoformat принимает пробел вместо 'T' и дробные секунды,
+    поэтому один вызов заменяет пару strptime с повтором по ValueError.
+    Не строки (datetime, None) возвращаются как есть, неразборчивая строка - None.
+    """
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    return value
+
+EARTH_RADIUS_M = 6371000  # Радиус Земли в метрах
+
+# До этого расстояния плоское приближение расходится с формулой гаверсинусов
+# на доли метра, дальше считаем точно
+EQUIRECTANGULAR_MAX_M = 1000
+
+def haversine_distance(lat1, lon1, lat2, lon2):
+    """Расстояние между двумя точками по формуле гаверсинусов, в метрах"""
+    lat1, lon1, lat2, lon2 = radians(lat1), radians(lon1), radians(lat2), radians(lon2)
+    
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    
+    a = sin(dlat / 2)**2 + cos(lat1) * cos(lat2) * sin(dlon / 2)**2
+    c = 2 * atan2(sqrt(a), sqrt(1 - a))
+    
+    return EARTH_RADIUS_M * c
+
+def distance_meters(lat1, lon1, lat2, lon2):
+    """Быстрое расстояние между соседними точками трека, в метрах
+    
+    Соседние обновления геопозиции лежат в десятках метров друг от друга,
+    поэтому сначала считаем равнопромежуточное приближение (один cos и hypot)
+    и только для далеких точек переходим к формуле гаверсинусов.
+    """
+    mean_lat = radians((lat1 + lat2) / 2)
+    x = radians(lon2 - lon1) * cos(mean_lat)
+    y = radians(lat2 - lat1)
+    distance = EARTH_RADIUS_M * hypot(x, y)
+    
+    if distance > EQUIRECTANGULAR_MAX_M:
+        return haversine_distance(lat1, lon1, lat2, lon2)
+    return distance
+
 def log_update(update):
     """Log information about the incoming update."""
     if update.message:
@@ -55,23 +258,29 @@ def is_workday():
     # 0 = Monday, 6 = Sunday
     return now.weekday() < 5
 
+@lru_cache(maxsize=1)
+def _get_extra_admin_ids():
+    """Разбирает ADMIN_IDS один раз за процесс - переменная окружения не меняется на лету"""
+    from config import ADMIN_IDS
+    
+    if not ADMIN_IDS:
+        return frozenset()
+    try:
+        return frozenset(int(id.strip()) for id in ADMIN_IDS.split(","))
+    except (ValueError, AttributeError) as e:
+        logger.error(f"Ошибка при разборе списка администраторов: {e}")
+        return frozenset()
+
 def is_admin(user_id):
     """Check if a user is an admin"""
-    from config import ADMIN_ID, ADMIN_IDS
+    from config import ADMIN_ID
     
     # Проверяем основного администратора
     if user_id == ADMIN_ID:
         return True
     
     # Проверяем список дополнительных администраторов
-    if ADMIN_IDS:
-        try:
-            admin_list = [int(id.strip()) for id in ADMIN_IDS.split(",")]
-            return user_id in admin_list
-        except (ValueError, AttributeError) as e:
-            logger.error(f"Ошибка при разборе списка администраторов: {e}")
-    
-    return False
+    return user_id in _get_extra_admin_ids()
 
 def create_map_for_user(user_id, locations, user_name=None, date=None):
     """Create a map with user's locations
@@ -158,16 +367,10 @@ def create_map_for_user(user_id, locations, user_name=None, date=None):
         try:
             # Преобразуем timestamp в datetime, если он строка
             if len(loc) >= 3:
-                timestamp = loc[2]
-                if isinstance(timestamp, str):
-                    try:
-                        timestamp = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S')
-                    except ValueError:
-                        try:
-                            timestamp = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S.%f')
-                        except Exception as e:
-                            logger.error(f"Не удалось распарсить timestamp: {e}")
-                            timestamp = datetime.now(MOSCOW_TZ)
+                timestamp = parse_timestamp(loc[2])
+                if timestamp is None:
+                    logger.error(f"Не удалось распарсить timestamp: {loc[2]}")
+                    timestamp = datetime.now(MOSCOW_TZ)
                 
                 # Создаем новый кортеж с datetime вместо строки
                 new_loc = list(loc)
@@ -189,6 +392,9 @@ def create_map_for_user(user_id, locations, user_name=None, date=None):
     avg_lat = sum(lats) / len(lats)
     avg_lon = sum(lons) / len(lons)
     
+    # folium нужен только для запасного построения карты - импортируем по требованию
+    import folium
+    
     # Create the map with OpenStreetMap tiles
     m = folium.Map(
         location=[avg_lat, avg_lon], 
@@ -265,22 +471,8 @@ def create_map_for_user(user_id, locations, user_name=None, date=None):
             
             # Если это не первая точка, рассчитываем расстояние и скорость
             if last_lat is not None and last_time is not None:
-                from math import sin, cos, sqrt, atan2, radians
-                
-                R = 6371000  # Радиус Земли в метрах
-                
-                lat1 = radians(float(last_lat))
-                lon1 = radians(float(last_lon))
-                lat2 = radians(float(lat))
-                lon2 = radians(float(lon))
-                
-                dlon = lon2 - lon1
-                dlat = lat2 - lat1
-                
-                a = sin(dlat / 2)**2 + cos(lat1) * cos(lat2) * sin(dlon / 2)**2
-                c = 2 * atan2(sqrt(a), sqrt(1 - a))
-                
-                distance = R * c  # Расстояние в метрах
+                # В отчете суммируем пройденный путь, поэтому считаем точно
+                distance = haversine_distance(float(last_lat), float(last_lon), float(lat), float(lon))
                 total_distance += distance
                 
                 # Расчет времени и скорости
@@ -334,20 +526,11 @@ def create_map_for_user(user_id, locations, user_name=None, date=None):
             try:
                 # Если timestamp - строка, пробуем преобразовать в datetime
                 if isinstance(timestamp, str):
-                    try:
-                        # Пытаемся разобрать строку в datetime
-                        display_time = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S')
-                    except ValueError:
-                        # Если не получилось стандартным форматом, пробуем другие варианты
-                        try:
-                            display_time = datetime.fromisoformat(timestamp)
-                        except ValueError:
-                            # Если все попытки не удались, используем строку как есть
-                            logger.warning(f"Невозможно преобразовать строку времени: {timestamp}")
-                            display_time = timestamp
-                            time_str = timestamp
-                            # Пропускаем дальнейшую обработку
-                            continue
+                    display_time = parse_timestamp(timestamp)
+                    if display_time is None:
+                        # Если разобрать не удалось, пропускаем дальнейшую обработку
+                        logger.warning(f"Невозможно преобразовать строку времени: {timestamp}")
+                        continue
                 # Если timestamp - объект datetime, используем его напрямую
                 elif isinstance(timestamp, datetime):
                     # Преобразуем timestamp в московское время, если он еще не в нем
@@ -422,7 +605,8 @@ def create_map_for_user(user_id, locations, user_name=None, date=None):
             path_times.append(time_str)
             path_speeds.append(speed)
             
-            logger.debug(f"Добавлена точка: {lat:.6f}, {lon:.6f}, {time_str}, {loc_type}, {speed:.1f} км/ч")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Добавлена точка: %.6f, %.6f, %s, %s, %.1f км/ч", lat, lon, time_str, loc_type, speed)
             
         except Exception as e:
             logger.error(f"Ошибка при обработке локации: {e}, данные: {loc_item}")
@@ -474,24 +658,31 @@ def create_map_for_user(user_id, locations, user_name=None, date=None):
     
     return map_filename
 
-def generate_csv_report(user_id, date=None, html_format=False):
+# Колонки CSV/HTML отчета
+REPORT_COLUMNS = ('ID', 'ФИО', 'Пользователь', 'Тип события', 'Значение', 'Время')
+
+def generate_csv_report(user_id, date=None, html_format=False, out=None):
     """Generate a CSV or HTML report for a user's activity on a specific date
     
     Args:
         user_id: ID пользователя
         date: Дата в формате строки 'YYYY-MM-DD', если None - используется сегодняшняя дата
         html_format: Если True, дополнительно создает HTML-версию отчета
+        out: Бинарный буфер (например, io.BytesIO); если передан, CSV пишется
+            в него без создания файла, html_format игнорируется
         
     Returns:
-        Путь к созданному файлу отчета (CSV или HTML)
+        Путь к созданному файлу отчета (CSV или HTML) или буфер out,
+        перемотанный в начало
     """
-    from database import get_user_status_history, get_today_locations_for_user, get_active_location_sessions, mark_session_ended
+    from database import get_user_status_history, get_today_locations_for_user, mark_all_sessions_ended
     from models import get_user_name_by_id, get_timeoff_stats_for_user, get_timeoff_requests_for_user
     from config import STATUS_OPTIONS
     
     # If date not provided, use today
+    today_date = today_str()
     if not date:
-        date = datetime.now(MOSCOW_TZ).strftime('%Y-%m-%d')
+        date = today_date
     
     # Get user name
     user_name = get_user_name_by_id(user_id) or f"User {user_id}"
@@ -499,14 +690,10 @@ def generate_csv_report(user_id, date=None, html_format=False):
     logger.info(f"Начало генерации отчета для {user_name} (ID: {user_id}) за {date}")
     
     # Перед получением данных закроем все активные сессии местоположений для актуальности
-    if date == datetime.now(MOSCOW_TZ).strftime('%Y-%m-%d'):  # Только для сегодняшней даты
-        try:
-            active_sessions = get_active_location_sessions(user_id)
-            for session_id in active_sessions:
-                mark_session_ended(session_id, user_id)
-                logger.info(f"Завершена активная сессия {session_id} для отчета пользователя {user_name}")
-        except Exception as e:
-            logger.error(f"Ошибка при закрытии активных сессий: {e}")
+    if date == today_date:  # Только для сегодняшней даты
+        closed = mark_all_sessions_ended(user_id)
+        if closed:
+            logger.info(f"Завершено {closed} активных сессий для отчета пользователя {user_name}")
     
     # Get status history for the specified date
     status_history = get_user_status_history(user_id, date=date)
@@ -539,17 +726,10 @@ def generate_csv_report(user_id, date=None, html_format=False):
         timeoff_requests = get_timeoff_requests_for_user(user_id)
         for req_id, reason, request_time, status, response_time in timeoff_requests:
             # Проверка является ли request_time объектом datetime или строкой
-            if isinstance(request_time, str):
-                try:
-                    req_timestamp = datetime.fromisoformat(request_time)
-                except ValueError:
-                    try:
-                        req_timestamp = datetime.strptime(request_time, '%Y-%m-%d %H:%M:%S')
-                    except Exception as e:
-                        logger.error(f"Не удалось распарсить timestamp запроса отгула: {e}")
-                        req_timestamp = datetime.now(MOSCOW_TZ)
-            else:
-                req_timestamp = request_time
+            req_timestamp = parse_timestamp(request_time)
+            if req_timestamp is None:
+                logger.error(f"Не удалось распарсить timestamp запроса отгула: {request_time}")
+                req_timestamp = datetime.now(MOSCOW_TZ)
                 
             # Сравниваем дату запроса с датой отчета
             if req_timestamp.strftime('%Y-%m-%d') == date:
@@ -591,14 +771,11 @@ def generate_csv_report(user_id, date=None, html_format=False):
         try:
             # Преобразование timestamp в datetime, если он строка
             if isinstance(timestamp, str):
-                try:
-                    timestamp = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S')
-                except ValueError:
-                    try:
-                        timestamp = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S.%f')
-                    except Exception as e:
-                        logger.error(f"Не удалось распарсить timestamp статуса: {e}")
-                        continue
+                parsed = parse_timestamp(timestamp)
+                if parsed is None:
+                    logger.error(f"Не удалось распарсить timestamp статуса: {timestamp}")
+                    continue
+                timestamp = parsed
             
             # Преобразуем код статуса в русское название
             status_display = status_translations.get(status, status)
@@ -618,20 +795,8 @@ def generate_csv_report(user_id, date=None, html_format=False):
     # Process location updates
     for loc in locations:
         try:
-            # Обрабатываем разные форматы данных о местоположении
-            if len(loc) >= 5:  # Полный формат с 5 полями
-                lat, lon, ts, session_id, loc_type = loc
-            elif len(loc) >= 4:  # Формат с 4 полями
-                lat, lon, ts, session_id = loc
-                loc_type = 'intermediate'
-            elif len(loc) >= 3:  # Минимальный формат с 3 полями
-                lat, lon, ts = loc[:3]
-                loc_type = 'intermediate'
-                session_id = None
-            else:
-                # Недостаточно данных, пропускаем
-                logger.warning(f"Недостаточно данных в записи о местоположении: {loc}")
-                continue
+            # get_today_locations_for_user отдает DayLocationRow
+            lat, lon, ts, loc_type = loc.latitude, loc.longitude, loc.timestamp, loc.location_type
             
             # Преобразование координат в числовой формат при необходимости
             if isinstance(lat, str):
@@ -641,14 +806,11 @@ def generate_csv_report(user_id, date=None, html_format=False):
                 
             # Преобразование timestamp в datetime, если он строка
             if isinstance(ts, str):
-                try:
-                    ts = datetime.strptime(ts, '%Y-%m-%d %H:%M:%S')
-                except ValueError:
-                    try:
-                        ts = datetime.strptime(ts, '%Y-%m-%d %H:%M:%S.%f')
-                    except Exception as e:
-                        logger.error(f"Не удалось распарсить timestamp локации: {e}")
-                        continue
+                parsed = parse_timestamp(ts)
+                if parsed is None:
+                    logger.error(f"Не удалось распарсить timestamp локации: {ts}")
+                    continue
+                ts = parsed
             
             # Перевод типов локаций на понятный язык
             location_type_translations = {
@@ -682,8 +844,7 @@ def generate_csv_report(user_id, date=None, html_format=False):
         item['id'] = i + 1
     
     # Импортируем необходимые библиотеки
-    from datetime import timedelta
-    import pytz
+    from datetime import timedelta, timezone
     
     def format_time_moscow(dt):
         """Форматирует время с учетом московского часового пояса"""
@@ -699,7 +860,7 @@ def generate_csv_report(user_id, date=None, html_format=False):
             elif hasattr(dt, 'astimezone'):
                 # Если у datetime есть часовой пояс, конвертируем его в UTC сначала,
                 # а затем добавляем смещение для московского времени
-                utc_time = dt.astimezone(pytz.UTC)
+                utc_time = dt.astimezone(timezone.utc)
                 moscow_time = utc_time + timedelta(hours=moscow_offset)
             else:
                 # Если это не datetime объект, просто возвращаем как есть
@@ -712,40 +873,45 @@ def generate_csv_report(user_id, date=None, html_format=False):
             # В случае ошибки, возвращаем входное значение как строку
             return str(dt)
     
-    # Создаем DataFrame и файл отчета
+    # Создаем файл отчета
     try:
-        # Создаем DataFrame с нужными колонками в нужном порядке
-        if report_data:
-            df = pd.DataFrame(report_data)
-        else:
-            # Если нет данных, создаем DataFrame с одной записью что данных нет
+        if not report_data:
+            # Если нет данных, создаем отчет с одной записью что данных нет
             logger.warning(f"Нет данных для отчета пользователя {user_name} (ID: {user_id}) за {date}")
-            df = pd.DataFrame([{
+            report_data = [{
                 'id': 1,
                 'name': user_name,
                 'user_id': user_id,
                 'event_type': 'Информация',
                 'value': 'Нет данных о местоположении и статусах за указанный период',
                 'timestamp': datetime.now(MOSCOW_TZ)
-            }])
-            
-        # Переименовываем колонки для отчета
-        df = df.rename(columns={
-            'id': 'ID',
-            'name': 'ФИО',
-            'user_id': 'Пользователь',
-            'event_type': 'Тип события',
-            'value': 'Значение',
-            'timestamp': 'Время'
-        })
+            }]
+        
+        # Строки отчета в порядке колонок REPORT_COLUMNS, время - по Москве
+        rows = [
+            (item['id'], item['name'], item['user_id'], item['event_type'], item['value'],
+             format_time_moscow(item['timestamp']))
+            for item in report_data
+        ]
         
-        # Применяем функцию конвертации к столбцу "Время"
-        df['Время'] = df['Время'].apply(format_time_moscow)
+        if out is not None:
+            # Отчет в памяти: без записи на диск и последующего удаления файла
+            text = io.StringIO(newline='')
+            writer = csv.writer(text)
+            writer.writerow(REPORT_COLUMNS)
+            writer.writerows(rows)
+            out.write(text.getvalue().encode('utf-8'))
+            out.seek(0)
+            logger.info(f"CSV отчет для {user_name} за {date} сформирован в памяти, {len(rows)} записей")
+            return out
         
         # Сохраняем в CSV файл
         csv_filename = f"report_{user_id}_{date}.csv"
-        df.to_csv(csv_filename, index=False, encoding='utf-8')
-        logger.info(f"CSV отчет успешно создан: {csv_filename}, {len(report_data) if report_data else 1} записей")
+        with open(csv_filename, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(REPORT_COLUMNS)
+            writer.writerows(rows)
+        logger.info(f"CSV отчет успешно создан: {csv_filename}, {len(rows)} записей")
         
         # Если запрошен HTML формат, создаем и HTML-версию
         if html_format:
@@ -825,19 +991,19 @@ def generate_csv_report(user_id, date=None, html_format=False):
                 <p><strong>Время формирования:</strong> {datetime.now(MOSCOW_TZ).strftime('%Y-%m-%d %H:%M:%S')}</p>
             """
             
-            # Улучшенное форматирование таблицы для HTML-отчета
-            # Добавляем класс timestamp к столбцу с временем для лучшего отображения
-            for i, col in enumerate(df.columns):
-                if col == 'Время':
-                    df[col] = df[col].apply(lambda x: f'<span class="timestamp">{x}</span>')
-            
-            # Преобразуем DataFrame в HTML таблицу с дополнительным форматированием
-            # Устанавливаем escape=False чтобы сохранить HTML-теги
-            table_html = df.to_html(index=False, classes='report-table', escape=False)
-            
-            # Заменяем стандартные стили на свои для строк с разными типами событий
-            table_html = table_html.replace('<tr>', '<tr class="status-event">')
-            table_html = table_html.replace('Местоположение', '</tr><tr class="location-event">Местоположение')
+            # Таблица отчета: строки местоположений и статусов выделяются разным фоном,
+            # время оформляется классом timestamp для лучшего отображения
+            table_parts = ['<table border="1" class="report-table">', '<thead>', '<tr>']
+            table_parts.extend(f'<th>{escape(column)}</th>' for column in REPORT_COLUMNS)
+            table_parts.extend(['</tr>', '</thead>', '<tbody>'])
+            for row in rows:
+                row_class = 'location-event' if row[3].startswith('Местоположение') else 'status-event'
+                table_parts.append(f'<tr class="{row_class}">')
+                table_parts.extend(f'<td>{escape(str(value))}</td>' for value in row[:-1])
+                table_parts.append(f'<td><span class="timestamp">{escape(row[-1])}</span></td>')
+                table_parts.append('</tr>')
+            table_parts.extend(['</tbody>', '</table>'])
+            table_html = "\n".join(table_parts)
             
             # Завершаем HTML файл
             html_footer = """
@@ -859,24 +1025,61 @@ def generate_csv_report(user_id, date=None, html_format=False):
         return csv_filename
         
     except Exception as e:
-        logger.error(f"Ошибка при создании DataFrame или сохранении файла: {e}")
-        # Создаем резервный отчет в случае ошибки DataFrame
+        logger.error(f"Ошибка при создании файла отчета: {e}")
+        # Создаем резервный отчет в случае ошибки
+        lines = ["ID,ФИО,Пользователь,Тип события,Значение,Время\n"]
+        if not report_data:
+            # Если нет данных, добавляем информационную строку
+            time_str = datetime.now(MOSCOW_TZ).strftime('%Y-%m-%d %H:%M:%S')
+            lines.append(f"1,{user_name},{user_id},Информация,Нет данных о местоположении и статусах за указанный период,{time_str}\n")
+        else:
+            for item in report_data:
+                # Форматируем время с учетом московского часового пояса
+                time_str = format_time_moscow(item['timestamp'])
+                lines.append(f"{item['id']},{item['name']},{item['user_id']},{item['event_type']},{item['value']},{time_str}\n")
+        
+        if out is not None:
+            out.seek(0)
+            out.truncate()
+            out.write("".join(lines).encode('utf-8'))
+            out.seek(0)
+            logger.info(f"Резервный CSV отчет для {user_name} за {date} сформирован в памяти")
+            return out
+        
         csv_filename = f"report_{user_id}_{date}.csv"
         with open(csv_filename, 'w', encoding='utf-8') as f:
-            f.write("ID,ФИО,Пользователь,Тип события,Значение,Время\n")
-            if not report_data:
-                # Если нет данных, добавляем информационную строку
-                time_str = datetime.now(MOSCOW_TZ).strftime('%Y-%m-%d %H:%M:%S')
-                f.write(f"1,{user_name},{user_id},Информация,Нет данных о местоположении и статусах за указанный период,{time_str}\n")
-            else:
-                for item in report_data:
-                    # Форматируем время с учетом московского часового пояса
-                    time_str = format_time_moscow(item['timestamp'])
-                    f.write(f"{item['id']},{item['name']},{item['user_id']},{item['event_type']},{item['value']},{time_str}\n")
+            f.writelines(lines)
         
         logger.info(f"Резервный CSV отчет успешно создан: {csv_filename}")
         return csv_filename
 
+def edit_message_smart(query, text, reply_markup=None, parse_mode=None):
+    """Изменить сообщение callback-запроса, отправляя только то, что поменялось
+    
+    Сравнивает с текущим сообщением из query.message: если текст тот же,
+    меняется только клавиатура (edit_message_reply_markup), если совпадает
+    и клавиатура - запрос в Telegram не отправляется. Текст с разметкой
+    Markdown/HTML сравнить нельзя, для него всегда выполняется полное изменение.
+    """
+    message = query.message
+    if message is not None and parse_mode is None and message.text == text:
+        current_markup = message.reply_markup.to_dict() if message.reply_markup else None
+        new_markup = reply_markup.to_dict() if reply_markup else None
+        if current_markup == new_markup:
+            return
+        try:
+            query.edit_message_reply_markup(reply_markup=reply_markup)
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                raise
+        return
+    
+    try:
+        query.edit_message_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+
 def get_admin_keyboard():
     """Create admin keyboard with admin functions"""
     keyboard = [